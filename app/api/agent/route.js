@@ -41,16 +41,23 @@ export async function POST(request) {
       
       let resultData = null;
       let errorOutput = '';
+      const emails = [];
+      let pending = '';
 
       python.stdout.on('data', (data) => {
-        const lines = data.toString().split('\n').filter(line => line.trim());
+        // Events are newline-delimited JSON; keep any partial line for the next chunk
+        pending += data.toString();
+        const lines = pending.split('\n');
+        pending = lines.pop();
         
-        lines.forEach(line => {
+        lines.filter(line => line.trim()).forEach(line => {
           try {
             const parsed = JSON.parse(line);
             
             if (parsed.type === 'result') {
               resultData = parsed.data;
+            } else if (parsed.type === 'email') {
+              emails.push(parsed.data);
             } else if (parsed.type === 'error') {
               errorOutput = parsed.message;
             }
@@ -75,7 +82,7 @@ export async function POST(request) {
         }
 
         if (code === 0 && resultData) {
-          resolve(NextResponse.json({ success: true, data: resultData }));
+          resolve(NextResponse.json({ success: true, data: { ...resultData, emails } }));
         } else {
           resolve(NextResponse.json({
             success: false,
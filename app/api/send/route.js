@@ -1,7 +1,108 @@
 import { NextResponse } from 'next/server';
 import { spawn } from 'child_process';
+import { randomUUID } from 'crypto';
 import path from 'path';
 
+// One long-lived Python sender shared by all requests. It runs in --daemon mode,
+// reading one batch per stdin line, so interpreter startup and SMTP logins are
+// paid once rather than on every send.
+let sender = null;
+
+// A batch gets this long to send once the sender starts it
+const SEND_TIMEOUT_MS = 30000;
+// Longest a request waits behind other batches before it is dropped unsent
+const QUEUE_TIMEOUT_MS = 60000;
+// Time a cancelled batch gets to stop and report what it sent before the sender is killed
+const CANCEL_GRACE_MS = 5000;
+
+function failBatches(batches, error) {
+  for (const [id, batch] of batches) {
+    batches.delete(id);
+    batch.finish({ success: false, error: batch.cancelled ? batch.cancelled.error : error, results: batch.results }, 500);
+  }
+}
+
+function getSender() {
+  if (sender) {
+    return sender;
+  }
+
+  const pythonScript = path.join(process.cwd(), 'scripts', 'send_emails.py');
+  // Use environment variable or default paths
+  const pythonPath = process.env.PYTHON_PATH || '/var/www/app/venv/bin/python3' || '/opt/venv/bin/python3' || 'python3';
+
+  const python = spawn(pythonPath, [pythonScript, '--daemon'], {
+    cwd: process.cwd(),
+    env: {
+      ...process.env,
+      PYTHONPATH: '/opt/venv/lib/python3.13/site-packages'
+    }
+  });
+
+  const current = { python, batches: new Map(), errorOutput: '' };
+  let pending = '';
+
+  python.stdout.on('data', (data) => {
+    // Events are newline-delimited JSON tagged with their batch id; keep any partial line for the next chunk
+    pending += data.toString();
+    const lines = pending.split('\n');
+    pending = lines.pop();
+
+    lines.filter(line => line.trim()).forEach(line => {
+      try {
+        const parsed = JSON.parse(line);
+        const batch = current.batches.get(parsed.batch);
+
+        if (parsed.type === 'error' && !batch) {
+          current.errorOutput = parsed.message;
+        } else if (!batch) {
+          // Events for a batch that was already answered
+        } else if (parsed.type === 'start') {
+          batch.start();
+        } else if (parsed.type === 'result') {
+          batch.results[parsed.index] = parsed.data;
+        } else if (parsed.type === 'summary') {
+          current.batches.delete(parsed.batch);
+          batch.finish({ ...parsed.data, results: batch.results });
+        } else if (parsed.type === 'error') {
+          current.batches.delete(parsed.batch);
+          batch.finish({ success: false, error: parsed.message, results: batch.results }, 500);
+        } else if (parsed.type === 'cancelled') {
+          // Results streamed before the stop show which emails did go out
+          current.batches.delete(parsed.batch);
+          const { error, status } = batch.cancelled || { error: 'Email sending was cancelled', status: 500 };
+          batch.finish({ ...parsed.data, success: false, error, results: batch.results }, status);
+        }
+      } catch (e) {
+        // Ignore non-JSON lines
+      }
+    });
+  });
+
+  python.stderr.on('data', (data) => {
+    // Only the latest stderr output is kept, so a long-lived sender doesn't accumulate logs
+    current.errorOutput = data.toString();
+    console.error('Email sender stderr:', data.toString());
+  });
+
+  python.on('error', (error) => {
+    current.errorOutput = error.message;
+  });
+
+  // Writes to a sender that is exiting fail here and are reported through 'close'
+  python.stdin.on('error', () => {});
+
+  python.on('close', () => {
+    if (sender === current) {
+      sender = null;
+    }
+    failBatches(current.batches, current.errorOutput || 'Failed to send emails');
+  });
+
+  sender = current;
+  return current;
+}
+
 export async function POST(request) {
   try {
     const { emails } = await request.json();
@@ -10,60 +111,50 @@ export async function POST(request) {
       return NextResponse.json({ success: false, error: 'No emails to send' }, { status: 400 });
     }
 
-    // Run Python email sender
-    const pythonScript = path.join(process.cwd(), 'scripts', 'send_emails.py');
-    // Use environment variable or default paths
-    const pythonPath = process.env.PYTHON_PATH || '/var/www/app/venv/bin/python3' || '/opt/venv/bin/python3' || 'python3';
-    
+    const current = getSender();
+    const id = randomUUID();
+
     return new Promise((resolve) => {
-      const python = spawn(pythonPath, [pythonScript, JSON.stringify(emails)], {
-        cwd: process.cwd(),
-        env: {
-          ...process.env,
-          PYTHONPATH: '/opt/venv/lib/python3.13/site-packages'
-        }
-      });
-      
-      let resultData = '';
-      let errorOutput = '';
-
-      python.stdout.on('data', (data) => {
-        resultData += data.toString();
-      });
-
-      python.stderr.on('data', (data) => {
-        errorOutput += data.toString();
-        console.error('Email sender stderr:', data.toString());
-      });
-
-      // Add timeout to kill process after 30 seconds
-      const timeout = setTimeout(() => {
-        python.kill();
-        resolve(NextResponse.json({
-          success: false,
-          error: 'Email sending timed out. Gmail SMTP may be blocked on this server. Consider using SendGrid instead.'
-        }, { status: 500 }));
-      }, 30000);
-
-      python.on('close', (code) => {
-        clearTimeout(timeout);
-        if (code === 0 && resultData) {
-          try {
-            const result = JSON.parse(resultData);
-            resolve(NextResponse.json(result));
-          } catch (e) {
-            resolve(NextResponse.json({
-              success: false,
-              error: 'Failed to parse email results'
-            }, { status: 500 }));
+      let timeout = null;
+
+      // Stop the batch rather than abandon it, so nothing more goes out once the user is told it failed
+      const cancel = (error, status) => {
+        batch.cancelled = { error, status };
+        current.python.stdin.write(JSON.stringify({ cancel: id }) + '\n');
+        timeout = setTimeout(() => {
+          // The sender did not stop in time; killing it (SIGTERM) still records the nudges it sent
+          if (sender === current) {
+            sender = null;
           }
-        } else {
-          resolve(NextResponse.json({
-            success: false,
-            error: errorOutput || 'Failed to send emails'
-          }, { status: 500 }));
+          current.python.kill();
+        }, CANCEL_GRACE_MS);
+      };
+
+      const batch = {
+        results: [],
+        cancelled: null,
+        // Batches run one at a time, so the send deadline starts when the sender picks this one up
+        start: () => {
+          if (batch.cancelled) {
+            return;
+          }
+          clearTimeout(timeout);
+          timeout = setTimeout(() => cancel(
+            'Email sending timed out and was stopped. Only emails marked sent in the results went out. Gmail SMTP may be blocked on this server. Consider using SendGrid instead.',
+            500
+          ), SEND_TIMEOUT_MS);
+        },
+        finish: (body, status = 200) => {
+          clearTimeout(timeout);
+          resolve(NextResponse.json(body, { status }));
         }
-      });
+      };
+      current.batches.set(id, batch);
+
+      // Bound the wait behind other batches; a batch dropped from the queue sent nothing
+      timeout = setTimeout(() => cancel('Email sender is busy with other batches. Nothing was sent; please try again.', 503), QUEUE_TIMEOUT_MS);
+
+      current.python.stdin.write(JSON.stringify({ id, emails }) + '\n');
     });
   } catch (error) {
     console.error('Error in send route:', error);
@@ -72,4 +163,4 @@ export async function POST(request) {
       error: error.message
     }, { status: 500 });
   }
-}
\ No newline at end of file
+}
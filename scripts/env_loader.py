@@ -0,0 +1,15 @@
+#!/usr/bin/env python3
+"""
+Optional .env loading shared by every script
+"""
+import os
+
+def load_env():
+    """Load .env unless DISABLE_DOTENV is set (CI, serverless) or python-dotenv is absent"""
+    if os.getenv('DISABLE_DOTENV'):
+        return
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        return
+    load_dotenv()
@@ -1,15 +1,48 @@
 #!/usr/bin/env python3
 import sys
 import os
-import json
+import re
+import orjson
+import time
+import random
+import asyncio
+import logging
+from string import Template
+import openpyxl
 import pandas as pd
-from typing import TypedDict, List, Dict, Any
+from dataclasses import dataclass
+from typing import TypedDict, List, Dict, Any, Optional
 from langgraph.graph import StateGraph, END
-from anthropic import Anthropic
-from dotenv import load_dotenv
-from nudge_system import get_nudge_level, get_nudge_config
-
-load_dotenv()
+from anthropic import Anthropic, AsyncAnthropic, RateLimitError
+from nudge_system import get_nudge_levels, get_nudge_config
+from env_loader import load_env
+
+load_env()
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class Config:
+    """Settings read from the environment once at import"""
+    anthropic_api_key: Optional[str]
+    form_url: str
+    from_name: str
+    max_concurrency: int      # concurrent Claude requests
+    requests_per_minute: int  # Claude rate limits
+    tokens_per_minute: int
+    batch_threshold: int      # with --batch, runs needing more requests than this use the Message Batches API
+    batch_timeout: float      # seconds to wait for a Message Batch before falling back to templates
+
+CONFIG = Config(
+    anthropic_api_key=os.getenv('ANTHROPIC_API_KEY'),
+    form_url=os.getenv('GOOGLE_FORM_URL', 'https://forms.gle/AFNpAnnS9aWURoQj9'),
+    from_name=os.getenv('FROM_NAME', 'IIIT Dharwad'),
+    max_concurrency=int(os.getenv('ANTHROPIC_MAX_CONCURRENCY', '10')),
+    requests_per_minute=int(os.getenv('ANTHROPIC_RPM', '50')),
+    tokens_per_minute=int(os.getenv('ANTHROPIC_TPM', '40000')),
+    batch_threshold=int(os.getenv('ANTHROPIC_BATCH_THRESHOLD', '20')),
+    batch_timeout=float(os.getenv('ANTHROPIC_BATCH_TIMEOUT', '3600'))
+)
 
 # Mandatory fields for student profile
 MANDATORY_FIELDS = [
@@ -26,6 +59,9 @@ MANDATORY_FIELDS = [
     'nationality'
 ]
 
+# Display label for each mandatory field (e.g. 'date_of_birth' -> 'Date Of Birth')
+FIELD_LABELS = {field: field.replace('_', ' ').title() for field in MANDATORY_FIELDS}
+
 # Column name mappings (Excel columns -> our field names)
 COLUMN_MAPPINGS = {
     'student name': 'student_name',
@@ -44,239 +80,23 @@ COLUMN_MAPPINGS = {
     'nationality': 'nationality'
 }
 
-# Agent State
-class AgentState(TypedDict):
-    file_path: str
-    students: List[Dict[str, Any]]
-    decisions: List[Dict[str, Any]]
-    generated_emails: List[Dict[str, Any]]
-    progress: int
-
-# Initialize Anthropic client
-client = Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
-
-def print_progress(message: str, progress: int):
-    """Print progress as JSON for streaming to frontend"""
-    print(json.dumps({
-        'type': 'progress',
-        'message': message,
-        'progress': progress
-    }), flush=True)
-
-def read_excel_node(state: AgentState) -> AgentState:
-    """Read Excel file and identify missing fields"""
-    print_progress('Reading Excel file...', 10)
-    
-    try:
-        df = pd.read_excel(state['file_path'])
-        
-        # Normalize column names (lowercase, strip spaces, collapse multiple spaces)
-        df.columns = df.columns.str.lower().str.strip()
-        
-        # Map Excel columns to our field names
-        mapped_df = pd.DataFrame()
-        for col in df.columns:
-            clean_col = col.replace('  ', ' ')  # collapse double spaces
-            if clean_col in COLUMN_MAPPINGS:
-                mapped_df[COLUMN_MAPPINGS[clean_col]] = df[col]
-        
-        students = []
-        for idx, row in df.iterrows():
-            student = {}
-            missing_fields = []
-            
-            # Check each mandatory field
-            for field in MANDATORY_FIELDS:
-                if field in mapped_df.columns:
-                    value = mapped_df.iloc[idx][field]
-                    # Check if value is missing (NaN, None, empty string)
-                    if pd.isna(value) or str(value).strip() == '':
-                        missing_fields.append(field)
-                        student[field] = None
-                    else:
-                        student[field] = str(value).strip()
-                else:
-                    missing_fields.append(field)
-                    student[field] = None
-            
-            # Calculate completion percentage
-            total_fields = len(MANDATORY_FIELDS)
-            completed_fields = total_fields - len(missing_fields)
-            completion = int((completed_fields / total_fields) * 100)
-            
-            student['missing_fields'] = missing_fields
-            student['completion'] = completion
-            student['row_index'] = idx
-            
-            students.append(student)
-        
-        print_progress(f'Found {len(students)} students in Excel', 20)
-        
-        return {
-            **state,
-            'students': students,
-            'progress': 20
-        }
-    
-    except Exception as e:
-        print(json.dumps({'type': 'error', 'message': str(e)}), flush=True)
-        raise
-
-def analyze_gaps_node(state: AgentState) -> AgentState:
-    """Analyze each student's profile gaps using AI"""
-    print_progress('Analyzing profile gaps with AI...', 30)
-    
-    students = state['students']
-    decisions = []
-    
-    # Filter only students with missing fields
-    incomplete_students = [s for s in students if len(s['missing_fields']) > 0]
-    
-    print_progress(f'Analyzing {len(incomplete_students)} incomplete profiles', 40)
-    
-    for idx, student in enumerate(incomplete_students):
-        # Use Claude to analyze this student
-        prompt = f"""You are an autonomous agent analyzing a student profile.
-
-Student Profile:
-- Name: {student.get('student_name', 'Unknown')}
-- Email: {student.get('email', 'Unknown')}
-- Completion: {student['completion']}%
-- Missing Fields: {', '.join(student['missing_fields'])}
-
-Analyze this student's situation and decide:
-1. How critical is this profile gap? (low/medium/high)
-2. What's the student's likely responsiveness? (low/medium/high)
-3. Should we prioritize this student? (yes/no)
-
-Provide your analysis as JSON:
-{{
-  "criticality": "low/medium/high",
-  "responsiveness": "low/medium/high",
-  "priority": "yes/no",
-  "reasoning": "brief explanation"
-}}
-
-Output ONLY the JSON, nothing else."""
-        
-        try:
-            response = client.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=500,
-                messages=[{
-                    "role": "user",
-                    "content": prompt
-                }]
-            )
-            
-            analysis = json.loads(response.content[0].text)
-            decisions.append({
-                'student_email': student.get('email', 'unknown'),
-                'student_name': student.get('student_name', 'Unknown'),
-                'analysis': analysis
-            })
-        
-        except Exception as e:
-            # Fallback decision
-            decisions.append({
-                'student_email': student.get('email', 'unknown'),
-                'student_name': student.get('student_name', 'Unknown'),
-                'analysis': {
-                    'criticality': 'medium',
-                    'responsiveness': 'medium',
-                    'priority': 'yes',
-                    'reasoning': f'Auto-analysis (API error: {str(e)})'
-                }
-            })
-    
-    print_progress('Gap analysis complete', 50)
-    
-    return {
-        **state,
-        'decisions': decisions,
-        'progress': 50
-    }
-
-def decide_strategy_node(state: AgentState) -> AgentState:
-    """Agent decides email strategy for each student"""
-    print_progress('AI deciding email strategy for each student...', 60)
-    
-    students = state['students']
-    decisions = state['decisions']
-    
-    # Update decisions with strategy
-    for decision in decisions:
-        student = next((s for s in students if s.get('email') == decision['student_email']), None)
-        if not student:
-            continue
-        
-        # Use Claude to decide email strategy
-        prompt = f"""You are an autonomous agent deciding email strategy.
+_WHITESPACE_RE = re.compile(r'\s+')
 
-Student: {decision['student_name']}
-Completion: {student['completion']}%
-Missing: {', '.join(student['missing_fields'])}
-Analysis: {decision['analysis']}
-
-Decide the best email strategy:
-1. Tone: friendly/professional/urgent
-2. Length: short/medium/detailed
-3. Emphasis: deadline/benefits/personal_touch
+def _normalize_column(name) -> str:
+    """Normalize a column header (lowercase, strip spaces, collapse repeated whitespace)"""
+    return _WHITESPACE_RE.sub(' ', str(name).strip().lower())
 
-Output JSON:
-{{
-  "tone": "friendly/professional/urgent",
-  "length": "short/medium/detailed",
-  "emphasis": "deadline/benefits/personal_touch",
-  "reasoning": "brief explanation"
-}}
+# COLUMN_MAPPINGS keyed on the normalized header form, built once at import
+NORMALIZED_COLUMN_MAPPINGS = {_normalize_column(k): v for k, v in COLUMN_MAPPINGS.items()}
 
-Output ONLY the JSON."""
-        
-        try:
-            response = client.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=500,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            
-            strategy = json.loads(response.content[0].text)
-            decision['strategy'] = strategy
-        
-        except Exception as e:
-            decision['strategy'] = {
-                'tone': 'professional',
-                'length': 'medium',
-                'emphasis': 'benefits',
-                'reasoning': f'Default strategy (API error: {str(e)})'
-            }
-    
-    print_progress('Email strategies decided', 70)
-    
-    return {
-        **state,
-        'decisions': decisions,
-        'progress': 70
-    }
+# Claude writes this placeholder instead of the student's name; it is filled in per student
+NAME_PLACEHOLDER = '{{STUDENT_NAME}}'
 
-def generate_emails_node(state: AgentState) -> AgentState:
-    """Generate personalized emails using Claude for each student"""
-    print_progress('Generating personalized emails with AI...', 80)
-    
-    students = state['students']
-    decisions = state['decisions']
-    decision_map = {d['student_email']: d for d in decisions}
-    
-    generated_emails = []
-    
-    form_url = os.getenv('GOOGLE_FORM_URL', 'https://forms.gle/AFNpAnnS9aWURoQj9')
-    from_name = os.getenv('FROM_NAME', 'IIIT Dharwad')
-    
-    # Email template to guide AI
-    template_guide = """
+# Email template to guide AI
+TEMPLATE_GUIDE = """
 Use this template structure but personalize it:
 
-Dear {{student_name}},
+Dear {{STUDENT_NAME}},
 Greetings from IIIT Dharwad! 👋
 
 We noticed that your student profile is incomplete, and a few important details are still missing. Please take a moment to update them so we can ensure your records are accurate and you get full access to all academic resources.
@@ -299,48 +119,91 @@ Let's make sure your journey at IIIT Dharwad continues smoothly and without inte
 Best regards,
 Team IIIT Dharwad
 """
-    
-    for student in students:
-        if len(student['missing_fields']) == 0:
-            continue  # Skip complete profiles
-        
-        student_email = student.get('email')
-        decision = decision_map.get(student_email, {})
-        strategy = decision.get('strategy', {})
-        
-        # Get nudge level for this student
-        nudge_level, days_since, can_send = get_nudge_level(student_email) if student_email else (1, 0, True)
-        nudge_config = get_nudge_config(nudge_level)
-        
-        # Adjust tone based on nudge level
-        tone_guidance = {
-            1: "Use a warm, friendly, and gentle tone. This is the first reminder.",
-            2: "Use a professional, encouraging tone with slight urgency. This is the second reminder (2 days after first).",
-            3: "Use an urgent, direct, but still respectful tone. This is the FINAL reminder (4 days after first). Emphasize deadline and consequences."
-        }
-        
-        # Generate personalized email using Claude
-        prompt = f"""You are an autonomous email generation agent for {from_name}.
 
-Generate a personalized email following this template structure:
+# Output token budget for each strategy length; the largest is the request's max_tokens
+LENGTH_TOKEN_BUDGETS = {'short': 800, 'medium': 1300, 'detailed': 2000}
 
-{template_guide}
+# Tone guidance for each nudge level
+TONE_GUIDANCE = {
+    1: "Use a warm, friendly, and gentle tone. This is the first reminder.",
+    2: "Use a professional, encouraging tone with slight urgency. This is the second reminder (2 days after first).",
+    3: "Use an urgent, direct, but still respectful tone. This is the FINAL reminder (4 days after first). Emphasize deadline and consequences."
+}
 
-Student Details:
-- Name: {student.get('student_name', 'Student')}
-- Completion: {student['completion']}%
-- Missing Fields: {', '.join(student['missing_fields'])}
+# Worked example appended to the instructions. Besides showing the expected style, it keeps
+# the cached prefix above the 1024-token minimum Claude needs before it will cache a prompt
+EXAMPLE_EMAIL = orjson.dumps({
+    'analysis': {
+        'criticality': 'medium',
+        'responsiveness': 'medium',
+        'priority': 'yes',
+        'reasoning': 'Three identity fields are missing at 72% completion, and the student did not respond to the first reminder.'
+    },
+    'strategy': {
+        'tone': 'professional',
+        'length': 'medium',
+        'emphasis': 'benefits',
+        'reasoning': 'A second reminder should stay polite but make the value of a complete profile concrete.'
+    },
+    'subject': 'Reminder: Complete Your IIIT Dharwad Profile - 3 Details Left',
+    'body_html': f"""<html>
+<body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
+  <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
+    <div style="background: #f5576c; color: white; padding: 20px; border-radius: 10px 10px 0 0;">
+      <h2 style="margin: 0;">IIIT Dharwad</h2>
+    </div>
+    <div style="background: #f9fafb; padding: 30px; border-radius: 0 0 10px 10px;">
+      <p>Dear <strong>{NAME_PLACEHOLDER}</strong>,</p>
+      <p>Greetings from IIIT Dharwad! 👋</p>
+      <p>This is a quick follow-up on our earlier note: your student profile is <strong>72% complete</strong>, and just three details are still missing. It only takes a couple of minutes to add them.</p>
+      <div style="background: #fff; padding: 15px; border-left: 4px solid #f59e0b; margin: 20px 0; border-radius: 5px;">
+        <p><strong>🧾 Missing fields:</strong></p>
+        <ul style="list-style: none; padding: 0;">
+          <li style="padding: 8px 0;">✦ <strong>Date Of Birth</strong></li>
+          <li style="padding: 8px 0;">✦ <strong>Gender</strong></li>
+          <li style="padding: 8px 0;">✦ <strong>Nationality</strong></li>
+        </ul>
+      </div>
+      <p><strong>Completing your profile helps you stay connected with:</strong></p>
+      <ul style="list-style: none; padding: 0;">
+        <li style="padding: 5px 0;">🎯 Class schedules and live sessions</li>
+        <li style="padding: 5px 0;">📚 Study materials and announcements</li>
+        <li style="padding: 5px 0;">🧩 Interactive academic activities</li>
+      </ul>
+      <p><strong>👉 Complete your profile here:</strong></p>
+      <p style="text-align: center;">
+        <a href="{CONFIG.form_url}" style="display: inline-block; background: #4285F4; color: white; padding: 15px 30px; text-decoration: none; border-radius: 8px; font-weight: bold;">Complete Profile Now</a>
+      </p>
+      <p>If you need any help, our Support Team is always here for you.</p>
+      <p>Let's make sure your journey at IIIT Dharwad continues smoothly and without interruption!</p>
+      <p style="text-align: center; color: #666; margin-top: 30px; font-size: 14px;"><strong>Best regards,</strong><br>Team IIIT Dharwad</p>
+    </div>
+  </div>
+</body>
+</html>"""
+}, option=orjson.OPT_INDENT_2).decode()
 
-Nudge Information:
-- Nudge Level: {nudge_level} of 3 ({nudge_config['description']})
-- Days Since Last: {days_since}
-- Tone: {tone_guidance[nudge_level]}
-- Urgency: {nudge_config['urgency']}
+# Instructions shared by every student, sent once per batch as a cached prompt prefix
+STATIC_PROMPT = f"""You are an autonomous email generation agent for {CONFIG.from_name}.
+
+First analyze this student's situation:
+1. How critical is this profile gap? (low/medium/high)
+2. What's the student's likely responsiveness? (low/medium/high)
+3. Should we prioritize this student? (yes/no)
+
+Then decide the best email strategy:
+1. Tone: friendly/professional/urgent
+2. Length: short/medium/detailed (keep your whole JSON response under about {LENGTH_TOKEN_BUDGETS['short']}/{LENGTH_TOKEN_BUDGETS['medium']}/{LENGTH_TOKEN_BUDGETS['detailed']} tokens respectively)
+3. Emphasis: deadline/benefits/personal_touch
+
+Finally, generate a personalized email that applies that strategy, following this template structure:
+
+{TEMPLATE_GUIDE}
 
 Requirements:
-1. Create a compelling subject line with prefix "{nudge_config['subject_prefix']}" (e.g., "{nudge_config['subject_prefix']}Complete Your IIIT Dharwad Profile")
+1. Create a compelling subject line starting with the subject prefix given in the nudge information
 2. Follow the template structure provided above
-3. Adjust tone based on nudge level (Nudge {nudge_level}):
+3. Adjust tone based on the nudge level:
    - Nudge 1: Warm, friendly, gentle reminder
    - Nudge 2: Professional, encouraging with slight urgency
    - Nudge 3: Urgent, direct - FINAL reminder with emphasis on consequences
@@ -348,67 +211,48 @@ Requirements:
 5. For Nudge 3, add urgency language like "Final Reminder", "Immediate Action Required"
 6. Format missing fields as a bulleted list with proper formatting
 7. Make it HTML formatted with professional styling
-8. Include the Google Form link: {form_url}
+8. Include the Google Form link: {CONFIG.form_url}
 9. Sign off as "Team IIIT Dharwad"
+10. Never write the student's actual name: use the literal placeholder {NAME_PLACEHOLDER} wherever the name belongs
 
 Output JSON:
 {{
+  "analysis": {{
+    "criticality": "low/medium/high",
+    "responsiveness": "low/medium/high",
+    "priority": "yes/no",
+    "reasoning": "brief explanation"
+  }},
+  "strategy": {{
+    "tone": "friendly/professional/urgent",
+    "length": "short/medium/detailed",
+    "emphasis": "deadline/benefits/personal_touch",
+    "reasoning": "brief explanation"
+  }},
   "subject": "subject with appropriate prefix and urgency",
-  "body_html": "full HTML email content with appropriate tone for nudge level {nudge_level}"
+  "body_html": "full HTML email content with appropriate tone for the nudge level"
 }}
 
-Output ONLY the JSON."""
-        
-        try:
-            response = client.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=2000,
-                messages=[{"role": "user", "content": prompt}]
-            )
-            
-            email_content = json.loads(response.content[0].text)
-            
-            generated_emails.append({
-                'student_email': student_email,
-                'student_name': student.get('student_name', 'Student'),
-                'subject': email_content['subject'],
-                'body_html': email_content['body_html'],
-                'missing_fields': student['missing_fields'],
-                'completion': student['completion'],
-                'nudge_level': nudge_level,
-                'nudge_config': nudge_config
-            })
-        
-        except Exception:
-            # Fallback email using template format
-            missing_fields_html = ''.join([f"<li>✦ <strong>{field.replace('_', ' ').title()}</strong></li>" for field in student['missing_fields']])
-            
-            # Get nudge styling based on level
-            header_color = {
-                1: 'linear-gradient(135deg, #667eea 0%, #764ba2 100%)',
-                2: 'linear-gradient(135deg, #f093fb 0%, #f5576c 100%)',
-                3: 'linear-gradient(135deg, #fa709a 0%, #fee140 100%)'
-            }.get(nudge_level, 'linear-gradient(135deg, #667eea 0%, #764ba2 100%)')
-            
-            generated_emails.append({
-                'student_email': student_email,
-                'student_name': student.get('student_name', 'Student'),
-                'subject': f'{nudge_config["subject_prefix"]}Complete Your IIIT Dharwad Profile - Action Needed',
-                'body_html': f'''<html>
+Example: for a student at 72% completion missing Date Of Birth, Gender and Nationality, on Nudge Level 2 of 3, a good response is:
+{EXAMPLE_EMAIL}"""
+
+# Fallback email used when Claude fails, pre-rendered per nudge level with
+# its header color so only the student-specific values are substituted
+_FALLBACK_HTML = """<html>
 <head>
     <style>
-        body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; }}
-        .container {{ max-width: 600px; margin: 0 auto; padding: 20px; }}
-        .header {{ background: {header_color}; color: white; padding: 20px; border-radius: 10px 10px 0 0; }}
-        .content {{ background: #f9fafb; padding: 30px; border-radius: 0 0 10px 10px; }}
-        .missing-fields {{ background: #fff; padding: 15px; border-left: 4px solid #f59e0b; margin: 20px 0; border-radius: 5px; }}
-        .missing-fields ul {{ list-style: none; padding: 0; }}
-        .missing-fields li {{ padding: 8px 0; }}
-        .benefits {{ background: #fff; padding: 15px; margin: 20px 0; border-radius: 5px; }}
-        .benefits ul {{ list-style: none; padding: 0; }}
-        .benefits li {{ padding: 5px 0; }}
-        .cta-button {{ display: inline-block; background: #4285F4; color: white; padding: 15px 30px; text-decoration: none; border-radius: 8px; font-weight: bold; margin: 20px 0; }}
-        .footer {{ text-align: center; color: #666; margin-top: 30px; font-size: 14px; }}
+        body { font-family: Arial, sans-serif; line-height: 1.6; color: #333; }
+        .container { max-width: 600px; margin: 0 auto; padding: 20px; }
+        .header { background: $header_color; color: white; padding: 20px; border-radius: 10px 10px 0 0; }
+        .content { background: #f9fafb; padding: 30px; border-radius: 0 0 10px 10px; }
+        .missing-fields { background: #fff; padding: 15px; border-left: 4px solid #f59e0b; margin: 20px 0; border-radius: 5px; }
+        .missing-fields ul { list-style: none; padding: 0; }
+        .missing-fields li { padding: 8px 0; }
+        .benefits { background: #fff; padding: 15px; margin: 20px 0; border-radius: 5px; }
+        .benefits ul { list-style: none; padding: 0; }
+        .benefits li { padding: 5px 0; }
+        .cta-button { display: inline-block; background: #4285F4; color: white; padding: 15px 30px; text-decoration: none; border-radius: 8px; font-weight: bold; margin: 20px 0; }
+        .footer { text-align: center; color: #666; margin-top: 30px; font-size: 14px; }
     </style>
 </head>
 <body>
@@ -417,14 +261,14 @@ Output ONLY the JSON."""
             <h2 style="margin:0;">IIIT Dharwad</h2>
         </div>
         <div class="content">
-            <p>Dear <strong>{student.get('student_name', 'Student')}</strong>,</p>
+            <p>Dear <strong>$student_name</strong>,</p>
             <p>Greetings from IIIT Dharwad! 👋</p>
             
-            <p>We noticed that your student profile is <strong>{student['completion']}% complete</strong>, and a few important details are still missing. Please take a moment to update them so we can ensure your records are accurate and you get full access to all academic resources.</p>
+            <p>We noticed that your student profile is <strong>$completion% complete</strong>, and a few important details are still missing. Please take a moment to update them so we can ensure your records are accurate and you get full access to all academic resources.</p>
             
             <div class="missing-fields">
                 <p><strong>🧾 Missing fields:</strong></p>
-                <ul>{missing_fields_html}</ul>
+                <ul>$missing_fields_html</ul>
             </div>
             
             <div class="benefits">
@@ -438,7 +282,7 @@ Output ONLY the JSON."""
             
             <p><strong>👉 Complete your profile here:</strong></p>
             <center>
-                <a href="{form_url}" class="cta-button">Complete Profile Now</a>
+                <a href="$form_url" class="cta-button">Complete Profile Now</a>
             </center>
             
             <p>If you need any help, our Support Team is always here for you.</p>
@@ -451,41 +295,414 @@ Output ONLY the JSON."""
         </div>
     </div>
 </body>
-</html>''',
+</html>"""
+
+NUDGE_HEADER_COLORS = {
+    1: 'linear-gradient(135deg, #667eea 0%, #764ba2 100%)',
+    2: 'linear-gradient(135deg, #f093fb 0%, #f5576c 100%)',
+    3: 'linear-gradient(135deg, #fa709a 0%, #fee140 100%)'
+}
+
+FALLBACK_TEMPLATES = {
+    level: Template(Template(_FALLBACK_HTML).safe_substitute(header_color=color))
+    for level, color in NUDGE_HEADER_COLORS.items()
+}
+
+# Agent State
+class AgentState(TypedDict):
+    file_path: str
+    students: List[Dict[str, Any]]
+    generated_emails: List[Dict[str, Any]]
+    use_batch: bool
+    progress: int
+
+# Retries for Claude rate limit errors
+MAX_RETRIES = 5
+
+BATCH_POLL_SECONDS = 5
+
+PROMPT_CACHING_HEADERS = {'anthropic-beta': 'prompt-caching-2024-07-31'}
+
+# Parsed Claude emails keyed on _email_cache_key, shared by students with identical gaps
+_email_cache: Dict[tuple, Dict[str, Any]] = {}
+
+class TokenBucket:
+    """Throttle Claude calls to stay under requests/min and tokens/min limits"""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self.requests = float(requests_per_minute)
+        self.tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens: int):
+        """Wait until one request and the estimated tokens are available"""
+        tokens = min(tokens, self.tpm)
+        while True:
+            self._refill()
+            if self.requests >= 1 and self.tokens >= tokens:
+                self.requests -= 1
+                self.tokens -= tokens
+                return
+            wait = max((1 - self.requests) / self.rpm, (tokens - self.tokens) / self.tpm) * 60
+            await asyncio.sleep(wait)
+
+rate_limiter = TokenBucket(CONFIG.requests_per_minute, CONFIG.tokens_per_minute)
+
+async def _create_message(aclient: AsyncAnthropic, sem: asyncio.Semaphore, **params):
+    """Call Claude under the concurrency cap, retrying rate limit errors with backoff"""
+    # Rough estimate: ~4 characters per input token plus the output budget
+    prompt_chars = 0
+    for message in params['messages']:
+        content = message['content']
+        if isinstance(content, str):
+            prompt_chars += len(content)
+        else:
+            prompt_chars += sum(len(block.get('text', '')) for block in content)
+    estimated_tokens = prompt_chars // 4 + params['max_tokens']
+    
+    for attempt in range(MAX_RETRIES):
+        await rate_limiter.acquire(estimated_tokens)
+        try:
+            async with sem:
+                return await aclient.messages.create(**params)
+        except RateLimitError:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(min(60, 2 ** attempt) + random.random())
+
+def _run_all(worker, items):
+    """Run worker(create, item) concurrently for all items, preserving order"""
+    async def runner():
+        sem = asyncio.Semaphore(CONFIG.max_concurrency)
+        async with AsyncAnthropic(api_key=CONFIG.anthropic_api_key) as aclient:
+            async def create(**params):
+                return await _create_message(aclient, sem, **params)
+            # The first call runs alone so it writes the prompt cache before the rest read it
+            first = [await worker(create, item) for item in items[:1]]
+            return first + await asyncio.gather(*[worker(create, item) for item in items[1:]])
+    
+    return asyncio.run(runner())
+
+def print_json(payload: Dict[str, Any]):
+    """Print one JSON event line for streaming to frontend"""
+    print(orjson.dumps(payload).decode(), flush=True)
+
+def print_progress(message: str, progress: int):
+    """Print progress as JSON for streaming to frontend"""
+    print_json({
+        'type': 'progress',
+        'message': message,
+        'progress': progress
+    })
+
+def _read_sheet(file_path: str):
+    """Yield the header row, then each data row, as tuples of cell values"""
+    if file_path.lower().endswith(('.xlsx', '.xlsm')):
+        # Stream rows instead of materializing the whole workbook
+        wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            yield from wb.active.iter_rows(values_only=True)
+        finally:
+            wb.close()
+    else:
+        # openpyxl can't read legacy .xls files
+        # object dtype keeps 101 from becoming 101.0 in columns with blanks; blanks become None like openpyxl's
+        df = pd.read_excel(file_path, dtype=object)
+        df = df.where(df.notna(), None)
+        yield tuple(df.columns)
+        yield from df.itertuples(index=False, name=None)
+
+def read_excel_node(state: AgentState) -> AgentState:
+    """Read Excel file and identify missing fields"""
+    print_progress('Reading Excel file...', 10)
+    
+    try:
+        rows = _read_sheet(state['file_path'])
+        headers = next(rows, ())
+        
+        # Map Excel columns to our field names
+        normalized = [_normalize_column(header) for header in headers]
+        field_columns = {
+            NORMALIZED_COLUMN_MAPPINGS[name]: col
+            for col, name in enumerate(normalized)
+            if name in NORMALIZED_COLUMN_MAPPINGS
+        }
+        
+        # Project each streamed row onto the mandatory fields (absent columns stay None)
+        positions = [field_columns.get(field) for field in MANDATORY_FIELDS]
+        records = []
+        row_indices = []
+        for idx, row in enumerate(rows):
+            # Skip fully blank rows (e.g. formatted but empty rows at the end of the sheet)
+            if all(value is None for value in row):
+                continue
+            records.append([row[col] if col is not None and col < len(row) else None for col in positions])
+            row_indices.append(idx)
+        
+        mapped_df = pd.DataFrame(records, columns=MANDATORY_FIELDS, dtype=object)
+        
+        # Check all fields at once: missing if NaN/None or blank after stripping
+        stripped = pd.DataFrame(
+            {field: mapped_df[field].astype(str).str.strip() for field in MANDATORY_FIELDS},
+            index=mapped_df.index
+        )
+        missing_mask = mapped_df.isna() | (stripped == '')
+        
+        # Calculate completion percentage
+        completion = (~missing_mask).sum(axis=1) * 100 // len(MANDATORY_FIELDS)
+        
+        students = []
+        rows = zip(row_indices, stripped.to_numpy(), missing_mask.to_numpy(), completion.to_numpy())
+        for idx, values, missing, row_completion in rows:
+            student = {field: None if is_missing else value for field, value, is_missing in zip(MANDATORY_FIELDS, values, missing)}
+            student['missing_fields'] = [field for field, is_missing in zip(MANDATORY_FIELDS, missing) if is_missing]
+            student['completion'] = int(row_completion)
+            student['row_index'] = idx
+            
+            students.append(student)
+        
+        print_progress(f'Found {len(students)} students in Excel', 20)
+        
+        state['students'] = students
+        state['progress'] = 20
+        return state
+    
+    except Exception as e:
+        print_json({'type': 'error', 'message': str(e)})
+        raise
+
+def _email_cache_key(student: Dict[str, Any], nudge_level: int) -> tuple:
+    """Everything the generated email depends on, apart from the student's name"""
+    return (frozenset(student['missing_fields']), nudge_level, student['completion'] // 10)
+
+def _email_request(student: Dict[str, Any], nudge_level: int, nudge_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the Claude request params for one student's email"""
+    # Per-student details; the static instructions are sent as a cached prefix.
+    # The name is left out so the response can be reused for every student with the same cache key.
+    prompt = f"""Student Details:
+- Completion: {student['completion']}%
+- Missing Fields: {', '.join(student['missing_fields'])}
+
+Nudge Information:
+- Nudge Level: {nudge_level} of 3 ({nudge_config['description']})
+- Tone: {TONE_GUIDANCE[nudge_level]}
+- Urgency: {nudge_config['urgency']}
+- Subject Prefix: "{nudge_config['subject_prefix']}" (e.g., "{nudge_config['subject_prefix']}Complete Your IIIT Dharwad Profile")
+
+Output ONLY the JSON."""
+    
+    return {
+        'model': "claude-3-5-sonnet-20241022",
+        'max_tokens': max(LENGTH_TOKEN_BUDGETS.values()),
+        'messages': [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": STATIC_PROMPT, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": prompt}
+            ]
+        }]
+    }
+
+def _run_batch(email_requests: List[Dict[str, Any]]) -> List[Any]:
+    """Submit all requests as one Message Batch and wait for the results, preserving order"""
+    if not email_requests:
+        return []
+    
+    # Any failure becomes a per-request exception, so those students get the fallback email
+    responses = [None] * len(email_requests)
+    
+    try:
+        client = Anthropic(api_key=CONFIG.anthropic_api_key)
+        # custom_id only allows [a-zA-Z0-9_-], so key results by position rather than email
+        batch = client.messages.batches.create(
+            requests=[{'custom_id': f'student-{i}', 'params': params} for i, params in enumerate(email_requests)],
+            extra_headers=PROMPT_CACHING_HEADERS
+        )
+    except Exception as e:
+        return [e for _ in email_requests]
+    
+    deadline = time.monotonic() + CONFIG.batch_timeout
+    missing = RuntimeError('Missing batch result')
+    try:
+        while batch.processing_status != 'ended':
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'Message Batch {batch.id} did not finish within {CONFIG.batch_timeout:.0f}s')
+            time.sleep(BATCH_POLL_SECONDS)
+            batch = client.messages.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            done = counts.succeeded + counts.errored + counts.canceled + counts.expired
+            print_progress(f'Batch processing: {done}/{len(email_requests)} emails generated', 40 + 50 * done // len(email_requests))
+        
+        for entry in client.messages.batches.results(batch.id):
+            index = int(entry.custom_id.split('-')[1])
+            if entry.result.type == 'succeeded':
+                responses[index] = entry.result.message
+            else:
+                responses[index] = RuntimeError(f'Batch request {entry.result.type}')
+    
+    except Exception as e:
+        if isinstance(e, TimeoutError):
+            # Stop paying for a batch nobody will read; best effort only
+            try:
+                client.messages.batches.cancel(batch.id)
+            except Exception:
+                pass
+        # Results read before the failure are kept
+        missing = e
+    
+    return [missing if response is None else response for response in responses]
+
+def generate_emails_node(state: AgentState) -> AgentState:
+    """Analyze gaps, decide strategy and generate the email in one Claude call per student"""
+    print_progress('Analyzing profiles and generating personalized emails with AI...', 40)
+    
+    students = state['students']
+    
+    # Skip complete profiles
+    incomplete_students = [s for s in students if len(s['missing_fields']) > 0]
+    
+    # Nudge level for each student, computed from one history load
+    levels = get_nudge_levels([s['email'] for s in incomplete_students if s.get('email')])
+    nudges = []
+    for student in incomplete_students:
+        student_email = student.get('email')
+        nudge_level, days_since, can_send = levels[student_email] if student_email else (1, 0, True)
+        nudges.append((nudge_level, get_nudge_config(nudge_level)))
+    
+    # Students sharing missing fields, nudge level and completion get the same email,
+    # so only one request is sent per distinct key not already cached
+    keys = [_email_cache_key(student, nudge[0]) for student, nudge in zip(incomplete_students, nudges)]
+    pending = {}
+    for student, (nudge_level, nudge_config), key in zip(incomplete_students, nudges, keys):
+        if key not in _email_cache and key not in pending:
+            pending[key] = _email_request(student, nudge_level, nudge_config)
+    
+    email_requests = list(pending.values())
+    
+    async def _generate_one(create, params):
+        try:
+            return await create(**params, extra_headers=PROMPT_CACHING_HEADERS)
+        except Exception as e:
+            return e
+    
+    # Claude is called concurrently; the Message Batches API is only used for large --batch runs,
+    # since its results can take minutes to arrive
+    if state.get('use_batch') and len(email_requests) > CONFIG.batch_threshold:
+        # One direct call writes the prompt cache that the batched requests then read
+        responses = _run_all(_generate_one, email_requests[:1]) + _run_batch(email_requests[1:])
+    else:
+        responses = _run_all(_generate_one, email_requests)
+    
+    # The cached prefix only pays off if later requests actually read it
+    usages = [response.usage for response in responses if not isinstance(response, Exception)]
+    if usages:
+        logger.info(
+            "Prompt cache: %d tokens read, %d written across %d responses",
+            sum(getattr(usage, 'cache_read_input_tokens', None) or 0 for usage in usages),
+            sum(getattr(usage, 'cache_creation_input_tokens', None) or 0 for usage in usages),
+            len(usages)
+        )
+    
+    errors = {}
+    for key, response in zip(pending, responses):
+        try:
+            if isinstance(response, Exception):
+                raise response
+            _email_cache[key] = orjson.loads(response.content[0].text)
+        except Exception as e:
+            errors[key] = e
+    
+    generated_emails = []
+    for student, (nudge_level, nudge_config), key in zip(incomplete_students, nudges, keys):
+        student_email = student.get('email')
+        student_name = student.get('student_name') or 'Student'
+        
+        try:
+            if key in errors:
+                raise errors[key]
+            
+            email_content = _email_cache[key]
+            
+            generated_emails.append({
+                'student_email': student_email,
+                'student_name': student_name,
+                'subject': email_content['subject'].replace(NAME_PLACEHOLDER, student_name),
+                'body_html': email_content['body_html'].replace(NAME_PLACEHOLDER, student_name),
+                'analysis': email_content.get('analysis', {}),
+                'strategy': email_content.get('strategy', {}),
                 'missing_fields': student['missing_fields'],
                 'completion': student['completion'],
                 'nudge_level': nudge_level,
                 'nudge_config': nudge_config
             })
+        
+        except Exception as e:
+            # Fallback email using template format
+            missing_fields_html = ''.join(f"<li>✦ <strong>{FIELD_LABELS[field]}</strong></li>" for field in student['missing_fields'])
+            
+            generated_emails.append({
+                'student_email': student_email,
+                'student_name': student_name,
+                'subject': f'{nudge_config["subject_prefix"]}Complete Your IIIT Dharwad Profile - Action Needed',
+                'body_html': FALLBACK_TEMPLATES.get(nudge_level, FALLBACK_TEMPLATES[1]).substitute(
+                    student_name=student_name,
+                    completion=student['completion'],
+                    missing_fields_html=missing_fields_html,
+                    form_url=CONFIG.form_url
+                ),
+                'analysis': {
+                    'criticality': 'medium',
+                    'responsiveness': 'medium',
+                    'priority': 'yes',
+                    'reasoning': f'Auto-analysis (API error: {str(e)})'
+                },
+                'strategy': {
+                    'tone': 'professional',
+                    'length': 'medium',
+                    'emphasis': 'benefits',
+                    'reasoning': f'Default strategy (API error: {str(e)})'
+                },
+                'missing_fields': student['missing_fields'],
+                'completion': student['completion'],
+                'nudge_level': nudge_level,
+                'nudge_config': nudge_config
+            })
+        
+        # Stream each email as soon as it is ready instead of in one final payload
+        print_json({'type': 'email', 'data': generated_emails[-1]})
     
     print_progress(f'Generated {len(generated_emails)} personalized emails', 90)
     
-    return {
-        **state,
-        'generated_emails': generated_emails,
-        'progress': 90
-    }
+    state['generated_emails'] = generated_emails
+    state['progress'] = 90
+    return state
 
 def finalize_node(state: AgentState) -> AgentState:
     """Finalize and prepare output"""
     print_progress('Finalizing results...', 100)
     
-    # Prepare final output
+    # Prepare final output (emails were already streamed as 'email' events)
     output = {
         'total_students': len(state['students']),
         'incomplete_students': len([s for s in state['students'] if len(s['missing_fields']) > 0]),
         'emails_generated': len(state['generated_emails']),
-        'students': state['students'],
-        'emails': state['generated_emails']
+        'students': state['students']
     }
     
     # Print final result as JSON
-    print(json.dumps({'type': 'result', 'data': output}), flush=True)
+    print_json({'type': 'result', 'data': output})
     
-    return {
-        **state,
-        'progress': 100
-    }
+    state['progress'] = 100
+    return state
 
 def build_agent():
     """Build the LangGraph agent"""
@@ -493,8 +710,6 @@ def build_agent():
     
     # Add nodes
     workflow.add_node('read_excel', read_excel_node)
-    workflow.add_node('analyze_gaps', analyze_gaps_node)
-    workflow.add_node('decide_strategy', decide_strategy_node)
     workflow.add_node('generate_emails', generate_emails_node)
     workflow.add_node('finalize', finalize_node)
     
@@ -502,23 +717,24 @@ def build_agent():
     workflow.set_entry_point('read_excel')
     
     # Add edges
-    workflow.add_edge('read_excel', 'analyze_gaps')
-    workflow.add_edge('analyze_gaps', 'decide_strategy')
-    workflow.add_edge('decide_strategy', 'generate_emails')
+    workflow.add_edge('read_excel', 'generate_emails')
     workflow.add_edge('generate_emails', 'finalize')
     workflow.add_edge('finalize', END)
     
     return workflow.compile()
 
 def main():
+    logging.basicConfig(level=os.getenv('LOGLEVEL', 'INFO').upper(), stream=sys.stderr, format='%(levelname)s: %(message)s')
+    
     if len(sys.argv) < 2:
-        print(json.dumps({'type': 'error', 'message': 'No file path provided'}), flush=True)
+        print_json({'type': 'error', 'message': 'No file path provided'})
         sys.exit(1)
     
     file_path = sys.argv[1]
+    use_batch = '--batch' in sys.argv[2:]
     
     if not os.path.exists(file_path):
-        print(json.dumps({'type': 'error', 'message': f'File not found: {file_path}'}), flush=True)
+        print_json({'type': 'error', 'message': f'File not found: {file_path}'})
         sys.exit(1)
     
     # Build and run the agent
@@ -527,15 +743,15 @@ def main():
     initial_state = {
         'file_path': file_path,
         'students': [],
-        'decisions': [],
         'generated_emails': [],
+        'use_batch': use_batch,
         'progress': 0
     }
     
     try:
         agent.invoke(initial_state)
     except Exception as e:
-        print(json.dumps({'type': 'error', 'message': str(e)}), flush=True)
+        print_json({'type': 'error', 'message': str(e)})
         sys.exit(1)
 
 if __name__ == '__main__':
@@ -3,39 +3,47 @@
 Nudge System for Student Profile Completion
 Tracks and manages 3-level nudging with escalation
 """
-import json
 import os
+import orjson
 from datetime import datetime, timedelta
 from pathlib import Path
 
 NUDGE_DATA_FILE = Path('nudge_history.json')
 
+# Parsed history, reused until the file's mtime changes
+_CACHE = {'mtime': None, 'data': None}
+
+def _history_mtime():
+    return NUDGE_DATA_FILE.stat().st_mtime_ns if NUDGE_DATA_FILE.exists() else None
+
 def load_nudge_history():
-    """Load nudge history from file"""
-    if NUDGE_DATA_FILE.exists():
-        with open(NUDGE_DATA_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+    """Load nudge history from file (cached until the file changes)"""
+    mtime = _history_mtime()
+    if _CACHE['data'] is not None and mtime == _CACHE['mtime']:
+        return _CACHE['data']
+    
+    history = orjson.loads(NUDGE_DATA_FILE.read_bytes()) if mtime is not None else {}
+    
+    _CACHE['mtime'] = mtime
+    _CACHE['data'] = history
+    return history
 
 def save_nudge_history(history):
     """Save nudge history to file"""
-    with open(NUDGE_DATA_FILE, 'w') as f:
-        json.dump(history, f, indent=2)
-
-def get_nudge_level(student_email):
-    """
-    Get the current nudge level for a student
-    Returns: (nudge_level, days_since_last_nudge, can_send)
-    """
-    history = load_nudge_history()
+    NUDGE_DATA_FILE.write_bytes(orjson.dumps(history))
     
+    _CACHE['mtime'] = _history_mtime()
+    _CACHE['data'] = history
+
+def _nudge_level_from_history(history, student_email, now):
+    """Compute (nudge_level, days_since_last_nudge, can_send) from loaded history"""
     if student_email not in history:
         return (1, 0, True)  # First nudge
     
     student_data = history[student_email]
     last_nudge_date = datetime.fromisoformat(student_data['last_nudge_date'])
     current_nudge = student_data['nudge_count']
-    days_since = (datetime.now() - last_nudge_date).days
+    days_since = (now - last_nudge_date).days
     
     # Can send if 2+ days have passed since last nudge
     can_send = days_since >= 2
@@ -49,21 +57,51 @@ def get_nudge_level(student_email):
     
     return (next_nudge, days_since, can_send)
 
+def get_nudge_level(student_email):
+    """
+    Get the current nudge level for a student
+    Returns: (nudge_level, days_since_last_nudge, can_send)
+    """
+    return _nudge_level_from_history(load_nudge_history(), student_email, datetime.now())
+
+def get_nudge_levels(student_emails):
+    """
+    Get nudge levels for many students with a single history load
+    Returns: {student_email: (nudge_level, days_since_last_nudge, can_send)}
+    """
+    history = load_nudge_history()
+    now = datetime.now()
+    
+    return {email: _nudge_level_from_history(history, email, now) for email in student_emails}
+
 def record_nudge(student_email, student_name, nudge_level):
     """Record that a nudge was sent"""
-    history = load_nudge_history()
+    record_nudges([(student_email, student_name, nudge_level)])
+
+def record_nudges(updates):
+    """
+    Record many sent nudges with a single load and save
+    updates: [(student_email, student_name, nudge_level), ...]
+    """
+    if not updates:
+        return
     
-    history[student_email] = {
-        'student_name': student_name,
-        'nudge_count': nudge_level,
-        'last_nudge_date': datetime.now().isoformat(),
-        'nudges': history.get(student_email, {}).get('nudges', []) + [
-            {
-                'level': nudge_level,
-                'date': datetime.now().isoformat()
-            }
-        ]
-    }
+    # Work on a copy so a failed save leaves the cached history matching the file
+    history = dict(load_nudge_history())
+    
+    for student_email, student_name, nudge_level in updates:
+        now = datetime.now().isoformat()
+        history[student_email] = {
+            'student_name': student_name,
+            'nudge_count': nudge_level,
+            'last_nudge_date': now,
+            'nudges': history.get(student_email, {}).get('nudges', []) + [
+                {
+                    'level': nudge_level,
+                    'date': now
+                }
+            ]
+        }
     
     save_nudge_history(history)
 
@@ -105,14 +143,11 @@ def get_students_needing_nudge(students):
     """
     results = []
     
-    for student in students:
-        if not student.get('email'):
-            continue
-        
-        if len(student.get('missing_fields', [])) == 0:
-            continue
-        
-        nudge_level, days_since, can_send = get_nudge_level(student['email'])
+    candidates = [s for s in students if s.get('email') and len(s.get('missing_fields', [])) > 0]
+    levels = get_nudge_levels([s['email'] for s in candidates])
+    
+    for student in candidates:
+        nudge_level, days_since, can_send = levels[student['email']]
         
         results.append({
             'student': student,
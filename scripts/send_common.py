@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Pieces shared by the Gmail and SendGrid senders: address checks, send pacing,
+NDJSON output and the batch/daemon driver
+"""
+import sys
+import re
+import time
+import signal
+import logging
+import asyncio
+import threading
+import orjson
+from nudge_system import record_nudges
+
+logger = logging.getLogger(__name__)
+
+# Cheap shape check that catches malformed addresses before they cost a send; fullmatch,
+# because $ would also accept a trailing newline that then breaks the RCPT TO line
+_EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+
+def is_valid_email(address):
+    return _EMAIL_RE.fullmatch(str(address)) is not None
+
+class TokenBucket:
+    """Pace sends to a steady rate with a small burst allowance"""
+    
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+    
+    async def acquire(self):
+        """Wait until a send token is available"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def print_json(payload):
+    """Print one NDJSON line on stdout; callers flush once per completed send"""
+    print(orjson.dumps(payload).decode(), flush=False)
+
+def print_event(event, batch_id=None):
+    # Daemon mode tags every event with its batch id so the caller can route it
+    if batch_id is not None:
+        event['batch'] = batch_id
+    print_json(event)
+
+def print_result(index, result, batch_id=None):
+    print_event({'type': 'result', 'index': index, 'data': result}, batch_id)
+
+def read_emails_data():
+    """Load the batch as NDJSON from stdin, one email object per line"""
+    # Deprecated: a single JSON array in argv[1] still works but is capped by the OS argument size limit
+    if len(sys.argv) > 1:
+        return orjson.loads(sys.argv[1])
+    return [orjson.loads(line) for line in sys.stdin if line.strip()]
+
+def record_sent(emails_data, results):
+    """Record nudges for every successful send in one history write"""
+    # One write per batch, so concurrent sends never race on nudge_history.json
+    pending = [
+        (emails_data[index]['student_email'], emails_data[index].get('student_name', 'Unknown'), emails_data[index].get('nudge_level', 1))
+        for index, result in results.items()
+        if result['status'] == 'success'
+    ]
+    try:
+        record_nudges(pending)
+    except Exception as e:
+        logger.error("Failed to record nudges: %s", e)
+
+def _counts(emails_data, results):
+    return {
+        'sent': sum(1 for result in results.values() if result['status'] == 'success'),
+        'skipped': sum(1 for result in results.values() if result['status'] == 'skipped'),
+        'total': len(emails_data)
+    }
+
+async def run_batch(send_batch, batch):
+    """Send one {"id": ..., "emails": [...]} batch and report it; returns False if the batch failed"""
+    batch_id = batch.get('id') if isinstance(batch, dict) else None
+    emails_data = []
+    results = {}
+    
+    def on_result(index, result):
+        results[index] = result
+        print_result(index, result, batch_id)
+    
+    # The caller times each batch from this event, not from when it was queued
+    print_event({'type': 'start'}, batch_id)
+    sys.stdout.flush()
+    
+    try:
+        if not isinstance(batch, dict) or not isinstance(batch.get('emails'), list):
+            raise ValueError('Batch must be an object with an "emails" list')
+        emails_data = batch['emails']
+        if not all(isinstance(email_data, dict) for email_data in emails_data):
+            raise ValueError('Every email must be an object')
+        await send_batch(emails_data, on_result)
+    except asyncio.CancelledError:
+        # Tell the caller how far the batch got before it was stopped
+        print_event({'type': 'cancelled', 'data': _counts(emails_data, results)}, batch_id)
+        sys.stdout.flush()
+        raise
+    except Exception as e:
+        message = f'Missing field {e}' if isinstance(e, KeyError) else str(e)
+        logger.error("Batch failed: %s", message)
+        print_event({'type': 'error', 'message': message}, batch_id)
+        sys.stdout.flush()
+        return False
+    finally:
+        # Also runs on failure or cancellation, so emails already sent are never nudged twice
+        record_sent(emails_data, results)
+    
+    counts = _counts(emails_data, results)
+    logger.info("FINAL SUMMARY - Total: %d, Sent: %d, Skipped: %d, Failed: %d", counts['total'], counts['sent'], counts['skipped'], counts['total'] - counts['sent'] - counts['skipped'])
+    
+    # Per-email results were already streamed as they completed
+    print_event({'type': 'summary', 'data': {'success': True, **counts}}, batch_id)
+    sys.stdout.flush()
+    return True
+
+def _read_stdin(loop, lines):
+    # Blocking reads live on a daemon thread, so a stop never waits for the next line
+    try:
+        for line in iter(sys.stdin.readline, ''):
+            loop.call_soon_threadsafe(lines.put_nowait, line)
+        loop.call_soon_threadsafe(lines.put_nowait, None)
+    except RuntimeError:
+        # Event loop already closed
+        pass
+
+async def serve(send_batch):
+    """Daemon mode: send one batch per stdin line, in order, until stdin closes"""
+    # Each line is {"id": ..., "emails": [...]} (or a bare array); events echo the id as "batch".
+    # A {"cancel": id} line stops that batch, or drops it if it has not started yet.
+    lines = asyncio.Queue()
+    threading.Thread(target=_read_stdin, args=(asyncio.get_running_loop(), lines), daemon=True).start()
+    
+    # Lines are read while a batch is sending, so a cancel can reach the batch it names
+    queued = asyncio.Queue()
+    waiting = {}
+    running = {}
+    
+    def cancel(batch_id):
+        if batch_id in running:
+            running[batch_id].cancel()
+        elif batch_id in waiting:
+            # Not started yet: drop it and answer at once, nothing was sent
+            emails_data = waiting.pop(batch_id).get('emails')
+            print_event({'type': 'cancelled', 'data': {'sent': 0, 'skipped': 0, 'total': len(emails_data) if isinstance(emails_data, list) else 0}}, batch_id)
+            sys.stdout.flush()
+    
+    async def read():
+        while (line := await lines.get()) is not None:
+            if not line.strip():
+                continue
+            
+            try:
+                batch = orjson.loads(line)
+            except orjson.JSONDecodeError as e:
+                queued.put_nowait((None, f'Invalid JSON: {str(e)}'))
+                continue
+            
+            if isinstance(batch, dict) and 'cancel' in batch:
+                cancel(batch['cancel'])
+                continue
+            
+            if isinstance(batch, list):
+                batch = {'emails': batch}
+            if isinstance(batch, dict) and batch.get('id') is not None:
+                waiting[batch['id']] = batch
+            queued.put_nowait((batch, None))
+        queued.put_nowait(None)
+    
+    async def send():
+        while (item := await queued.get()) is not None:
+            batch, error = item
+            if error:
+                print_json({'type': 'error', 'message': error})
+                sys.stdout.flush()
+                continue
+            
+            batch_id = batch.get('id') if isinstance(batch, dict) else None
+            if batch_id is not None:
+                if waiting.pop(batch_id, None) is None:
+                    # Cancelled while queued and already answered
+                    continue
+                running[batch_id] = task = asyncio.create_task(run_batch(send_batch, batch))
+            else:
+                task = asyncio.create_task(run_batch(send_batch, batch))
+            
+            try:
+                await task
+            except asyncio.CancelledError:
+                # A cancel line stops only its batch; anything else (SIGTERM) stops the daemon
+                if not task.cancelled() or asyncio.current_task().cancelling():
+                    raise
+            finally:
+                running.pop(batch_id, None)
+    
+    await asyncio.gather(read(), send())
+
+async def run_sender(send_batch, emails_data=None):
+    """Send emails_data as one batch, or serve batches from stdin when it is None"""
+    # SIGTERM cancels the running batch, which still records the nudges it sent
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        # No signal handlers on Windows event loops
+        pass
+    
+    try:
+        if emails_data is None:
+            await serve(send_batch)
+            return True
+        return await run_batch(send_batch, {'emails': emails_data})
+    except asyncio.CancelledError:
+        logger.warning("Stopped by SIGTERM")
+        return False
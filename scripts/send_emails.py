@@ -1,150 +1,457 @@
 #!/usr/bin/env python3
 import sys
 import os
-import json
-import smtplib
+import logging
+import orjson
+import time
+import random
+import asyncio
+import aiosmtplib
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Optional
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from dotenv import load_dotenv
-from nudge_system import record_nudge
+from email import policy
+from email.utils import make_msgid
+from send_common import TokenBucket, is_valid_email, print_json, read_emails_data, run_sender
+from env_loader import load_env
 
-load_dotenv()
+load_env()
 
-def send_email(to_email, subject, body_html, from_name, smtp_user, smtp_password):
-    """Send email via Gmail SMTP - OPTIMIZED"""
-    try:
-        # Create message
-        message = MIMEMultipart('alternative')
+logger = logging.getLogger(__name__)
+
+# Gmail starts refusing connections beyond roughly this many concurrent sessions per account
+MAX_SMTP_CONCURRENCY = 15
+
+@dataclass(frozen=True)
+class Config:
+    """Settings read from the environment once at import"""
+    smtp_user: Optional[str]
+    smtp_password: str
+    from_name: str
+    smtp_concurrency: int  # concurrent sends, each over its own connection
+    send_rps: float  # sustained sends per second across all connections
+
+CONFIG = Config(
+    smtp_user=os.getenv('GMAIL_USER'),
+    smtp_password=os.getenv('GMAIL_APP_PASSWORD', '').replace(' ', ''),  # Remove any spaces
+    from_name=os.getenv('FROM_NAME', 'IIIT Dharwad'),
+    smtp_concurrency=max(1, min(int(os.getenv('SMTP_CONCURRENCY', '5')), MAX_SMTP_CONCURRENCY)),
+    send_rps=float(os.getenv('SEND_RPS', '10'))
+)
+
+@dataclass(frozen=True)
+class SmtpCreds:
+    """Gmail login and sender identity, prepared once and shared by every send"""
+    user: str
+    password: str
+    from_name: str
+    
+    @cached_property
+    def from_header(self):
         # IMPORTANT: Use actual Gmail user as From address to avoid Gmail blocking
-        message['From'] = f'{from_name} <{smtp_user}>'
-        message['To'] = to_email
-        message['Subject'] = subject
-        
-        # Add HTML body
-        html_part = MIMEText(body_html, 'html')
-        message.attach(html_part)
+        return f'{self.from_name} <{self.user}>'
+    
+    @cached_property
+    def domain(self):
+        return self.user.split('@')[-1]
+
+# Gmail limits messages per SMTP session, so connections are rotated after this many;
+# an envelope counts once per recipient, since each recipient gets its own copy
+MAX_MESSAGES_PER_CONNECTION = 100
+# Connections idle longer than this get a NOOP before reuse
+IDLE_PROBE_SECONDS = 30
+RECONNECT_BACKOFF_SECONDS = 1.0
+# Gmail rejects envelopes with too many RCPT TO commands, so shared messages are split at this size
+MAX_RECIPIENTS_PER_MESSAGE = 50
+
+# Transient SMTP replies (service busy, mailbox unavailable, TLS not ready) are retried;
+# anything else, such as 550/553 for a bad recipient, fails immediately
+TRANSIENT_SMTP_CODES = {421, 450, 451, 454}
+MAX_SEND_ATTEMPTS = 3
+RETRY_BASE_SECONDS = 1.0
+RETRY_CAP_SECONDS = 30.0
+
+_BUCKET = TokenBucket(CONFIG.send_rps, burst=20)
+
+# Port that last connected successfully; later connections skip straight to it so a
+# blocked 587 costs one timeout per process instead of one per connection
+_PREFERRED_PORT: Optional[int] = None
+
+async def _open_smtp(port, creds):
+    """Connect and log in to Gmail SMTP on one port"""
+    if port == 587:
+        # Option 1: port 587 with STARTTLS (standard)
+        server = aiosmtplib.SMTP(hostname='smtp.gmail.com', port=587, timeout=10, start_tls=False)
+    else:
+        # Option 2: port 465 with SSL (alternative)
+        server = aiosmtplib.SMTP(hostname='smtp.gmail.com', port=465, timeout=10, use_tls=True)
+    
+    await server.connect()
+    try:
+        if port == 587:
+            await server.starttls()
+        await server.login(creds.user, creds.password)
+    except Exception:
+        server.close()
+        raise
+    
+    logger.info("Connected to Gmail SMTP on port %d as %s", port, creds.user)
+    return server
+
+async def connect_smtp(creds):
+    """Open an authenticated Gmail SMTP connection, reused for the whole batch"""
+    global _PREFERRED_PORT
+    ports = [587, 465]
+    if _PREFERRED_PORT in ports:
+        ports.remove(_PREFERRED_PORT)
+        ports.insert(0, _PREFERRED_PORT)
+    
+    for attempt, port in enumerate(ports):
+        try:
+            server = await _open_smtp(port, creds)
+        except aiosmtplib.SMTPAuthenticationError:
+            # Bad credentials fail on every port; forget the latch so a fixed password re-probes
+            _PREFERRED_PORT = None
+            raise
+        except Exception as e:
+            if attempt == len(ports) - 1:
+                raise
+            logger.warning("Port %d failed: %s, trying port %d...", port, e, ports[attempt + 1])
+            continue
         
-        print(f"DEBUG: Sending to {to_email} via {smtp_user}", file=sys.stderr, flush=True)
+        _PREFERRED_PORT = port
+        return server
+
+class SmtpConnection:
+    """Persistent SMTP session that health-checks, reconnects and rotates itself"""
+    
+    def __init__(self, creds):
+        self.creds = creds
+        self.server = None
+        self.sent = 0
+        self.last_used = time.monotonic()
+    
+    async def connect(self):
+        self.server = await connect_smtp(self.creds)
+        self.sent = 0
+        self.last_used = time.monotonic()
+        return self
+    
+    async def _healthy(self):
+        try:
+            return (await self.server.noop()).code == 250
+        except (aiosmtplib.SMTPException, OSError):
+            return False
+    
+    async def reconnect(self):
+        await self.close()
+        await self.connect()
+    
+    async def sendmail(self, from_addr, to_addrs, msg):
+        # Rotate long-lived sessions before this envelope would take them past the recipient cap,
+        # and probe ones that sat idle long enough to be dropped
+        if self.sent and self.sent + len(to_addrs) > MAX_MESSAGES_PER_CONNECTION:
+            await self.reconnect()
+        elif time.monotonic() - self.last_used > IDLE_PROBE_SECONDS and not await self._healthy():
+            await self.reconnect()
         
-        # Option 1: Try port 587 with STARTTLS (standard)
+        # One token per recipient, so SEND_RPS paces delivered mail rather than envelopes
+        for _ in to_addrs:
+            await _BUCKET.acquire()
         try:
-            with smtplib.SMTP('smtp.gmail.com', 587, timeout=10) as server:
-                server.set_debuglevel(0)  # Disable verbose debug
-                server.starttls()
-                server.login(smtp_user, smtp_password)
-                server.sendmail(smtp_user, to_email, message.as_string())
-            
-            print(f"DEBUG: ✓ Email sent successfully to {to_email}", file=sys.stderr, flush=True)
-            return {'status': 'success', 'email': to_email}
+            result = await self.server.sendmail(from_addr, to_addrs, msg)
+        except (aiosmtplib.SMTPServerDisconnected, OSError) as e:
+            # Connection dropped mid-batch: reconnect once and retry this message
+            delay = RECONNECT_BACKOFF_SECONDS + random.uniform(0, RECONNECT_BACKOFF_SECONDS)
+            logger.warning("SMTP connection lost (%s), reconnecting in %.1fs", e, delay)
+            await asyncio.sleep(delay)
+            await self.reconnect()
+            result = await self.server.sendmail(from_addr, to_addrs, msg)
         
-        except Exception as e1:
-            print(f"DEBUG: Port 587 failed: {str(e1)}, trying port 465...", file=sys.stderr, flush=True)
-            
-            # Option 2: Try port 465 with SSL (alternative)
-            import smtplib
-            from smtplib import SMTP_SSL
-            
-            with SMTP_SSL('smtp.gmail.com', 465, timeout=10) as server:
-                server.login(smtp_user, smtp_password)
-                server.sendmail(smtp_user, to_email, message.as_string())
-            
-            print(f"DEBUG: ✓ Email sent via port 465 to {to_email}", file=sys.stderr, flush=True)
-            return {'status': 'success', 'email': to_email}
-    
-    except smtplib.SMTPAuthenticationError as e:
-        error_msg = f'Authentication failed. Check GMAIL_APP_PASSWORD'
-        print(f"DEBUG ERROR: {error_msg} - {str(e)}", file=sys.stderr, flush=True)
-        return {'status': 'error', 'email': to_email, 'error': error_msg}
-    
-    except smtplib.SMTPException as e:
-        error_msg = f'SMTP error: {str(e)}'
-        print(f"DEBUG ERROR: {error_msg}", file=sys.stderr, flush=True)
-        return {'status': 'error', 'email': to_email, 'error': error_msg}
+        self.sent += len(to_addrs)
+        self.last_used = time.monotonic()
+        return result
     
-    except Exception as e:
-        error_msg = f'Connection error: {str(e)}'
-        print(f"DEBUG ERROR: {error_msg}", file=sys.stderr, flush=True)
-        return {'status': 'error', 'email': to_email, 'error': error_msg}
+    async def close(self):
+        try:
+            await self.server.quit()
+        except Exception:
+            self.server.close()
 
-def main():
-    if len(sys.argv) < 2:
-        print(json.dumps({'error': 'No emails data provided'}), flush=True)
-        sys.exit(1)
+async def open_connections(count, creds):
+    """Open up to `count` SMTP connections; the first must succeed, the rest are best effort"""
+    # Connect once up front so bad credentials fail fast instead of once per task
+    connections = [await SmtpConnection(creds).connect()]
+    
+    extras = await asyncio.gather(
+        *(SmtpConnection(creds).connect() for _ in range(count - 1)),
+        return_exceptions=True
+    )
+    for connection in extras:
+        if isinstance(connection, BaseException):
+            logger.warning("Extra SMTP connection failed: %s", connection)
+        else:
+            connections.append(connection)
     
-    # Parse emails JSON from argument
+    return connections
+
+def _smtp_error_code(error):
+    """Reply code behind an SMTP error, including per-recipient refusals"""
+    if isinstance(error, aiosmtplib.SMTPRecipientsRefused):
+        return error.recipients[0].code if error.recipients else None
+    return getattr(error, 'code', None)
+
+def _smtp_error_text(error):
+    """Uniform 'SMTP error: <code> <message>' text for replies and per-recipient refusals"""
+    code = getattr(error, 'code', None)
+    if code is None:
+        return f'SMTP error: {str(error)}'
+    return f'SMTP error: {code} {error.message}'
+
+def _retry_delay(attempt):
+    return min(RETRY_CAP_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt) + random.uniform(0, 0.5)
+
+async def _with_retry(fn, max_attempts=MAX_SEND_ATTEMPTS):
+    """Await fn(), retrying transient SMTP replies with capped exponential backoff and jitter"""
+    for attempt in range(max_attempts):
+        try:
+            return await fn()
+        except aiosmtplib.SMTPException as e:
+            if attempt == max_attempts - 1 or _smtp_error_code(e) not in TRANSIENT_SMTP_CODES:
+                raise
+            delay = _retry_delay(attempt)
+            logger.warning("Transient SMTP error (%s), retrying in %.1fs", e, delay)
+            await asyncio.sleep(delay)
+
+async def _deliver(server, from_addr, to_emails, msg):
+    """Send one envelope and return {address: refusal} for the recipients the server refused"""
     try:
-        emails_data = json.loads(sys.argv[1])
-    except json.JSONDecodeError as e:
-        print(json.dumps({'error': f'Invalid JSON: {str(e)}'}), flush=True)
-        sys.exit(1)
+        refused, _ = await server.sendmail(from_addr, to_emails, msg)
+    except aiosmtplib.SMTPRecipientsRefused as e:
+        # Every recipient was refused; report them the same way as a partial refusal
+        return {error.recipient: error for error in e.recipients}
+    return refused
+
+def build_message(subject, body_html, creds):
+    """Serialize a message once for every recipient sharing its subject and body"""
+    message = MIMEMultipart('alternative')
+    message['From'] = creds.from_header
+    message['Subject'] = subject
     
-    # Get SMTP credentials from environment
-    smtp_user = os.getenv('GMAIL_USER')
-    smtp_password = os.getenv('GMAIL_APP_PASSWORD', '').replace(' ', '')  # Remove any spaces
-    from_name = os.getenv('FROM_NAME', 'IIIT Dharwad')
+    # Add HTML body
+    html_part = MIMEText(body_html, 'html')
+    message.attach(html_part)
     
-    if not smtp_user or not smtp_password:
-        print(json.dumps({'error': 'Gmail credentials not configured'}), flush=True)
-        sys.exit(1)
+    # To and Message-ID are left out and prepended per recipient in send_email.
+    # Bytes go straight onto the wire, so sendmail never re-encodes the body.
+    return message.as_bytes()
+
+def _header_bytes(name, value):
+    """Encode one header line the way the email package would, refusing CR/LF in the value"""
+    return policy.default.fold_binary(*policy.default.header_store_parse(name, value))
+
+async def send_email(server, to_emails, message, creds):
+    """Send one prebuilt message to every address in to_emails in a single SMTP envelope"""
+    # Recipients of a shared envelope stay hidden from each other, as with Bcc
+    to_header = to_emails[0] if len(to_emails) == 1 else 'undisclosed-recipients:;'
+    # Message-ID is fixed before any retry, so a resent copy is recognised as the same message
+    try:
+        msg = _header_bytes('To', to_header) + _header_bytes('Message-ID', make_msgid(domain=creds.domain)) + message
+    except ValueError as e:
+        # CR/LF in an address would otherwise inject extra headers into the shared message
+        error_msg = f'Invalid header: {str(e)}'
+        logger.error(error_msg)
+        return [{'status': 'error', 'email': to_email, 'error': error_msg} for to_email in to_emails]
+    
+    logger.debug("Sending to %s via %s", to_emails, creds.user)
+    # A student listed twice in one group is sent one copy
+    pending = list(dict.fromkeys(to_emails))
+    delivered = set()
+    errors = {}
+    try:
+        for attempt in range(MAX_SEND_ATTEMPTS):
+            refused = await _with_retry(lambda: _deliver(server, creds.user, pending, msg))
+            delivered.update(to_email for to_email in pending if to_email not in refused)
+            errors.update((to_email, _smtp_error_text(error)) for to_email, error in refused.items())
+            # Recipients refused with a transient code get the same backoff as a refused envelope
+            pending = [to_email for to_email in pending if to_email in refused and refused[to_email].code in TRANSIENT_SMTP_CODES]
+            if not pending or attempt == MAX_SEND_ATTEMPTS - 1:
+                break
+            delay = _retry_delay(attempt)
+            logger.warning("Transient refusal for %d recipients, retrying in %.1fs", len(pending), delay)
+            await asyncio.sleep(delay)
     
-    print(f"DEBUG: Sending {len(emails_data)} emails via Gmail ({smtp_user})", file=sys.stderr, flush=True)
-    print(f"DEBUG: Password length: {len(smtp_password)} chars", file=sys.stderr, flush=True)
+    # A failed round only fails the recipients it was sending to; earlier rounds stay delivered
+    except aiosmtplib.SMTPException as e:
+        error_msg = _smtp_error_text(e)
+        logger.error(error_msg)
+        errors.update((to_email, error_msg) for to_email in pending)
+    
+    except Exception as e:
+        error_msg = f'Connection error: {str(e)}'
+        logger.error(error_msg)
+        errors.update((to_email, error_msg) for to_email in pending)
     
     results = []
-    success_count = 0
-    skipped_count = 0
+    for to_email in to_emails:
+        if to_email in delivered:
+            logger.debug("✓ Email sent successfully to %s", to_email)
+            results.append({'status': 'success', 'email': to_email})
+        else:
+            logger.error("%s refused: %s", to_email, errors[to_email])
+            results.append({'status': 'error', 'email': to_email, 'error': errors[to_email]})
+    return results
+
+def has_email(email_data):
+    student_email = email_data.get('student_email')
+    return bool(student_email) and student_email != 'None' and str(student_email).strip() != ''
+
+async def send_all(emails_data, creds, on_result=None, pool=None):
+    """Send every email concurrently over a pool of persistent SMTP connections"""
+    results = [None] * len(emails_data)
+    # A caller-supplied pool (daemon mode) is kept open across batches
+    owns_pool = pool is None
+    if owns_pool:
+        pool = asyncio.Queue()
     
-    for email_data in emails_data:
-        student_email = email_data.get('student_email')
-        
-        # Skip if student has no email address
-        if not student_email or student_email == 'None' or str(student_email).strip() == '':
-            print(f"DEBUG: Skipping - no email for {email_data.get('student_name', 'Unknown')}", file=sys.stderr, flush=True)
-            results.append({
+    def report(index, result):
+        results[index] = result
+        if on_result:
+            on_result(index, result)
+    
+    # Students sharing a subject and body get one message, serialized once and
+    # delivered with one DATA per envelope of up to MAX_RECIPIENTS_PER_MESSAGE
+    groups = {}
+    for index, email_data in enumerate(emails_data):
+        if not has_email(email_data):
+            # Skip if student has no email address
+            logger.debug("Skipping - no email for %s", email_data.get('student_name', 'Unknown'))
+            report(index, {
                 'status': 'skipped',
                 'email': None,
                 'error': 'Student has no email address'
             })
-            skipped_count += 1
             continue
+        if not is_valid_email(email_data['student_email']):
+            logger.debug("Skipping - invalid email %r", email_data['student_email'])
+            report(index, {
+                'status': 'skipped',
+                'email': email_data['student_email'],
+                'error': 'Invalid email address'
+            })
+            continue
+        groups.setdefault((email_data['subject'], email_data['body_html']), []).append(index)
+    
+    envelopes = [
+        (key, indices[start:start + MAX_RECIPIENTS_PER_MESSAGE])
+        for key, indices in groups.items()
+        for start in range(0, len(indices), MAX_RECIPIENTS_PER_MESSAGE)
+    ]
+    
+    # Pool of persistent SMTP connections, one per concurrent send; between batches
+    # every connection is back in the queue, so only the shortfall is opened
+    connection_error = None
+    wanted = min(CONFIG.smtp_concurrency, len(envelopes)) - pool.qsize()
+    if wanted > 0:
+        try:
+            for connection in await open_connections(wanted, creds):
+                pool.put_nowait(connection)
+        except aiosmtplib.SMTPAuthenticationError as e:
+            connection_error = 'Authentication failed. Check GMAIL_APP_PASSWORD'
+            logger.error("%s - %s", connection_error, e)
+        except Exception as e:
+            connection_error = f'Connection error: {str(e)}'
+            logger.error(connection_error)
         
-        print(f"DEBUG: Processing email for {student_email}", file=sys.stderr, flush=True)
-        
-        result = send_email(
-            student_email,
-            email_data['subject'],
-            email_data['body_html'],
-            from_name,
-            smtp_user,
-            smtp_password
-        )
+        # Connections kept from earlier batches can still carry this one
+        if connection_error and not pool.empty():
+            connection_error = None
+    
+    messages = {key: build_message(*key, creds) for key in groups}
+    semaphore = asyncio.Semaphore(CONFIG.smtp_concurrency)
+    
+    async def process(key, indices):
+        to_emails = [emails_data[index]['student_email'] for index in indices]
+        logger.debug("Processing email for %s", to_emails)
         
-        print(f"DEBUG: Result for {student_email}: {result['status']}", file=sys.stderr, flush=True)
+        if connection_error:
+            return indices, [{'status': 'error', 'email': to_email, 'error': connection_error} for to_email in to_emails]
         
-        results.append(result)
-        if result['status'] == 'success':
-            success_count += 1
-            # Record nudge after successful send
-            try:
-                nudge_level = email_data.get('nudge_level', 1)
-                record_nudge(
-                    student_email,
-                    email_data.get('student_name', 'Unknown'),
-                    nudge_level
-                )
-            except Exception as e:
-                print(f"DEBUG: Failed to record nudge: {str(e)}", file=sys.stderr, flush=True)
-    
-    # Final summary
-    print(f"DEBUG: FINAL SUMMARY - Total: {len(emails_data)}, Sent: {success_count}, Skipped: {skipped_count}, Failed: {len(emails_data) - success_count - skipped_count}", file=sys.stderr, flush=True)
-    
-    print(json.dumps({
-        'success': True,
-        'sent': success_count,
-        'skipped': skipped_count,
-        'total': len(emails_data),
-        'results': results
-    }), flush=True)
+        try:
+            async with semaphore:
+                connection = await pool.get()
+                try:
+                    return indices, await send_email(connection, to_emails, messages[key], creds)
+                finally:
+                    pool.put_nowait(connection)
+        except Exception as e:
+            return indices, [{'status': 'error', 'email': to_email, 'error': str(e)} for to_email in to_emails]
+    
+    # Report each envelope as soon as it finishes rather than after the slowest one
+    tasks = [asyncio.create_task(process(key, indices)) for key, indices in envelopes]
+    for next_done in asyncio.as_completed(tasks):
+        indices, outcome = await next_done
+        for index, result in zip(indices, outcome):
+            logger.debug("Result for %s: %s", result['email'], result['status'])
+            report(index, result)
+        sys.stdout.flush()
+    
+    if owns_pool:
+        await close_pool(pool)
+    
+    return results
+
+async def close_pool(pool):
+    while not pool.empty():
+        await pool.get_nowait().close()
+
+async def run(creds, emails_data=None):
+    """Send one batch, or every batch on stdin when emails_data is None, over one connection pool"""
+    # The pool stays open across daemon batches and is closed once at the end
+    pool = asyncio.Queue()
+    
+    async def send_batch(batch, on_result):
+        logger.info("Sending %d emails via Gmail (%s)", len(batch), creds.user)
+        return await send_all(batch, creds, on_result=on_result, pool=pool)
+    
+    try:
+        return await run_sender(send_batch, emails_data)
+    finally:
+        await close_pool(pool)
+
+def main():
+    logging.basicConfig(level=os.getenv('LOGLEVEL', 'INFO').upper(), stream=sys.stderr, format='%(levelname)s: %(message)s')
+    
+    daemon = '--daemon' in sys.argv[1:]
+    if daemon:
+        sys.argv.remove('--daemon')
+    
+    # SMTP credentials from environment
+    if not CONFIG.smtp_user or not CONFIG.smtp_password:
+        print_json({'type': 'error', 'message': 'Gmail credentials not configured'})
+        sys.exit(1)
+    
+    creds = SmtpCreds(CONFIG.smtp_user, CONFIG.smtp_password, CONFIG.from_name)
+    logger.debug("Password length: %d chars", len(creds.password))
+    
+    if daemon:
+        asyncio.run(run(creds))
+        return
+    
+    if len(sys.argv) < 2 and sys.stdin.isatty():
+        print_json({'type': 'error', 'message': 'No emails data provided'})
+        sys.exit(1)
+    
+    try:
+        emails_data = read_emails_data()
+    except orjson.JSONDecodeError as e:
+        print_json({'type': 'error', 'message': f'Invalid JSON: {str(e)}'})
+        sys.exit(1)
+    
+    if not asyncio.run(run(creds, emails_data)):
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -4,169 +4,253 @@ Email sender using SendGrid (faster and more reliable for cloud deployments)
 """
 import sys
 import os
-import json
-from dotenv import load_dotenv
+import logging
+import orjson
+import random
+import asyncio
+import httpx
+from dataclasses import dataclass
+from typing import Optional
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from env_loader import load_env
+from send_common import TokenBucket, is_valid_email, print_json, read_emails_data, run_sender
+# The Gmail fallback reuses the SMTP sender and its settings (credentials, FROM_NAME, SMTP_CONCURRENCY)
+import send_emails
 
-load_dotenv()
+load_env()
 
-def send_email_sendgrid(to_email, subject, body_html, from_email, from_name):
-    """Send email via SendGrid API (much faster than SMTP)"""
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class Config:
+    """SendGrid settings read from the environment once at import"""
+    sendgrid_api_key: Optional[str]
+    from_email: str
+    send_rps: float  # sustained API calls per second
+
+CONFIG = Config(
+    sendgrid_api_key=os.getenv('SENDGRID_API_KEY'),
+    from_email=os.getenv('FROM_EMAIL', 'noreply@iiitd.ac.in'),
+    send_rps=float(os.getenv('SEND_RPS', '100'))
+)
+
+SENDGRID_SEND_URL = 'https://api.sendgrid.com/v3/mail/send'
+# Most personalizations (recipients) /v3/mail/send accepts in one request
+MAX_PERSONALIZATIONS = 1000
+
+# One pooled keep-alive client shared by every SendGrid call, so TLS is negotiated once per batch
+_HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=10,
+    limits=httpx.Limits(max_keepalive_connections=10, max_connections=20)
+)
+
+# Throttling and server errors are retried; other failures are returned as-is
+MAX_SEND_ATTEMPTS = 3
+RETRY_BASE_SECONDS = 1.0
+RETRY_CAP_SECONDS = 30.0
+
+
+# SendGrid's API takes far more per second than a Gmail mailbox does
+_BUCKET = TokenBucket(CONFIG.send_rps, burst=20)
+
+
+def _retry_after(response):
+    """Seconds requested by a Retry-After header (delta-seconds or HTTP-date), if any"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
     try:
-        # Try importing sendgrid
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_transient(outcome):
+    if isinstance(outcome, httpx.TransportError):
+        return True
+    if isinstance(outcome, httpx.Response):
+        return outcome.status_code == 429 or outcome.status_code >= 500
+    return False
+
+
+async def _with_retry(fn, max_attempts=MAX_SEND_ATTEMPTS):
+    """Await fn(), retrying 429/5xx responses and transport errors with capped backoff"""
+    for attempt in range(max_attempts):
         try:
-            from sendgrid import SendGridAPIClient
-            from sendgrid.helpers.mail import Mail, Email, To, Content
-        except ImportError:
-            return {
-                'status': 'error', 
-                'email': to_email, 
-                'error': 'SendGrid not installed. Run: pip install sendgrid'
-            }
+            outcome = await fn()
+        except Exception as e:
+            if attempt == max_attempts - 1 or not _is_transient(e):
+                raise
+            outcome = e
+        else:
+            if attempt == max_attempts - 1 or not _is_transient(outcome):
+                return outcome
+        
+        # Honour the server's Retry-After when it gives one, otherwise back off exponentially
+        delay = _retry_after(outcome) if isinstance(outcome, httpx.Response) else None
+        if delay is None:
+            delay = min(RETRY_CAP_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt)
+        delay += random.uniform(0, 0.5)
+        logger.warning("Transient send failure (%s), retrying in %.1fs", getattr(outcome, 'status_code', outcome), delay)
+        await asyncio.sleep(delay)
+
+
+async def send_email_sendgrid(recipients, body_html, from_email, from_name):
+    """Send one body to many (email, subject) recipients in a single SendGrid API call"""
+    def failed(error):
+        return [{'status': 'error', 'email': to_email, 'error': error} for to_email, _ in recipients]
+    
+    try:
+        if not CONFIG.sendgrid_api_key:
+            return failed('SENDGRID_API_KEY not configured')
         
-        sendgrid_api_key = os.getenv('SENDGRID_API_KEY')
-        if not sendgrid_api_key:
-            return {
-                'status': 'error',
-                'email': to_email,
-                'error': 'SENDGRID_API_KEY not configured'
-            }
+        # Post straight to the v3 API; the stock SendGridAPIClient blocks the event loop.
+        # Each recipient is its own personalization, so nobody sees the other addresses.
+        # The payload is built once, so every retry resends the identical request
+        payload = {
+            'personalizations': [
+                {'to': [{'email': to_email}], 'subject': subject}
+                for to_email, subject in recipients
+            ],
+            'from': {'email': from_email, 'name': from_name},
+            'content': [{'type': 'text/html', 'value': body_html}]
+        }
+        headers = {'Authorization': f'Bearer {CONFIG.sendgrid_api_key}'}
         
-        # Create SendGrid message
-        message = Mail(
-            from_email=Email(from_email, from_name),
-            to_emails=To(to_email),
-            subject=subject,
-            html_content=Content("text/html", body_html)
-        )
+        async def post():
+            await _BUCKET.acquire()
+            return await _HTTP.post(SENDGRID_SEND_URL, headers=headers, json=payload)
         
-        # Send via SendGrid API
-        sg = SendGridAPIClient(sendgrid_api_key)
-        response = sg.send(message)
+        response = await _with_retry(post)
         
-        print(f"DEBUG: SendGrid response status: {response.status_code}", file=sys.stderr, flush=True)
+        logger.debug("SendGrid response status for %d recipients: %s", len(recipients), response.status_code)
         
         if response.status_code == 202:
-            return {'status': 'success', 'email': to_email}
+            return [{'status': 'success', 'email': to_email} for to_email, _ in recipients]
         else:
-            return {'status': 'error', 'email': to_email, 'error': f'SendGrid error: {response.status_code}'}
+            return failed(f'SendGrid error: {response.status_code}')
     
     except Exception as e:
-        return {'status': 'error', 'email': to_email, 'error': str(e)}
+        return failed(str(e))
 
 
-def send_email_gmail(to_email, subject, body_html, from_email, from_name, smtp_user, smtp_password):
-    """Fallback: Send email via Gmail SMTP"""
-    import smtplib
-    from email.mime.text import MIMEText
-    from email.mime.multipart import MIMEMultipart
+async def send_all(emails_data, from_email, from_name, concurrency, on_result=None):
+    """Send every email concurrently, at most `concurrency` API calls in flight at once"""
+    semaphore = asyncio.Semaphore(concurrency)
+    results = [None] * len(emails_data)
     
-    try:
-        message = MIMEMultipart('alternative')
-        message['From'] = f'{from_name} <{from_email}>'
-        message['To'] = to_email
-        message['Subject'] = subject
-        
-        html_part = MIMEText(body_html, 'html')
-        message.attach(html_part)
-        
-        with smtplib.SMTP('smtp.gmail.com', 587, timeout=5) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.sendmail(smtp_user, to_email, message.as_string())
-        
-        return {'status': 'success', 'email': to_email}
+    def report(index, result):
+        results[index] = result
+        if on_result:
+            on_result(index, result)
     
-    except Exception as e:
-        return {'status': 'error', 'email': to_email, 'error': str(e)}
+    # Students sharing a body go out together, up to SendGrid's personalization limit per call
+    groups = {}
+    for index, email_data in enumerate(emails_data):
+        if not email_data.get('student_email'):
+            report(index, {
+                'status': 'skipped',
+                'email': None,
+                'error': 'Student has no email address'
+            })
+            continue
+        if not is_valid_email(email_data['student_email']):
+            # SendGrid rejects the whole request if any personalization has a malformed address
+            report(index, {
+                'status': 'skipped',
+                'email': email_data['student_email'],
+                'error': 'Invalid email address'
+            })
+            continue
+        groups.setdefault(email_data['body_html'], []).append(index)
+    
+    async def process(body_html, indices):
+        recipients = [(emails_data[index]['student_email'], emails_data[index]['subject']) for index in indices]
+        async with semaphore:
+            return indices, await send_email_sendgrid(recipients, body_html, from_email, from_name)
+    
+    # Report each call as soon as it finishes rather than after the slowest one
+    tasks = [
+        asyncio.create_task(process(body_html, indices[start:start + MAX_PERSONALIZATIONS]))
+        for body_html, indices in groups.items()
+        for start in range(0, len(indices), MAX_PERSONALIZATIONS)
+    ]
+    for next_done in asyncio.as_completed(tasks):
+        indices, outcome = await next_done
+        for index, result in zip(indices, outcome):
+            report(index, result)
+        sys.stdout.flush()
+    
+    return results
 
 
-def main():
-    if len(sys.argv) < 2:
-        print(json.dumps({'error': 'No emails data provided'}), flush=True)
-        sys.exit(1)
+async def run(from_email, from_name, creds, concurrency, emails_data=None):
+    """Send one batch, or every batch on stdin when emails_data is None, then close shared connections"""
+    # Gmail connections are pooled across daemon batches, like the SendGrid client
+    pool = asyncio.Queue()
+    
+    async def send_batch(batch, on_result):
+        if creds is None:
+            return await send_all(batch, from_email, from_name, concurrency, on_result=on_result)
+        # Reuse the pooled Gmail sender, which logs in once per connection rather than per message
+        return await send_emails.send_all(batch, creds, on_result=on_result, pool=pool)
     
     try:
-        emails_data = json.loads(sys.argv[1])
-    except json.JSONDecodeError as e:
-        print(json.dumps({'error': f'Invalid JSON: {str(e)}'}), flush=True)
-        sys.exit(1)
+        return await run_sender(send_batch, emails_data)
+    finally:
+        if creds is not None:
+            await send_emails.close_pool(pool)
+        await _HTTP.aclose()
+
+
+def main():
+    logging.basicConfig(level=os.getenv('LOGLEVEL', 'INFO').upper(), stream=sys.stderr, format='%(levelname)s: %(message)s')
     
-    # Get credentials
-    from_email = os.getenv('FROM_EMAIL', 'noreply@iiitd.ac.in')
-    from_name = os.getenv('FROM_NAME', 'IIIT Dharwad')
-    sendgrid_api_key = os.getenv('SENDGRID_API_KEY')
+    daemon = '--daemon' in sys.argv[1:]
+    if daemon:
+        sys.argv.remove('--daemon')
+    
+    from_name = send_emails.CONFIG.from_name
     
     # Decide which service to use
-    use_sendgrid = bool(sendgrid_api_key)
+    use_sendgrid = bool(CONFIG.sendgrid_api_key)
+    creds = None
     
     if use_sendgrid:
-        print("DEBUG: Using SendGrid for email delivery", file=sys.stderr, flush=True)
+        logger.info("Using SendGrid for email delivery")
     else:
-        print("DEBUG: Using Gmail SMTP (slower, may timeout)", file=sys.stderr, flush=True)
-        smtp_user = os.getenv('GMAIL_USER')
-        smtp_password = os.getenv('GMAIL_APP_PASSWORD', '').replace(' ', '')
-        
-        if not smtp_user or not smtp_password:
-            print(json.dumps({'error': 'No email credentials configured'}), flush=True)
+        logger.info("Using Gmail SMTP (slower, may timeout)")
+        if not send_emails.CONFIG.smtp_user or not send_emails.CONFIG.smtp_password:
+            print_json({'type': 'error', 'message': 'No email credentials configured'})
             sys.exit(1)
+        
+        creds = send_emails.SmtpCreds(send_emails.CONFIG.smtp_user, send_emails.CONFIG.smtp_password, from_name)
     
-    results = []
-    success_count = 0
-    skipped_count = 0
+    # Send concurrently; SendGrid caps simultaneous connections per account, so the SMTP clamp applies too
+    concurrency = send_emails.CONFIG.smtp_concurrency
     
-    for email_data in emails_data:
-        if not email_data.get('student_email'):
-            results.append({
-                'status': 'skipped',
-                'email': None,
-                'error': 'Student has no email address'
-            })
-            skipped_count += 1
-            continue
-        
-        # Send email
-        if use_sendgrid:
-            result = send_email_sendgrid(
-                email_data['student_email'],
-                email_data['subject'],
-                email_data['body_html'],
-                from_email,
-                from_name
-            )
-        else:
-            result = send_email_gmail(
-                email_data['student_email'],
-                email_data['subject'],
-                email_data['body_html'],
-                from_email,
-                from_name,
-                smtp_user,
-                smtp_password
-            )
-        
-        results.append(result)
-        if result['status'] == 'success':
-            success_count += 1
-            
-            # Record nudge
-            try:
-                from nudge_system import record_nudge
-                nudge_level = email_data.get('nudge_level', 1)
-                record_nudge(
-                    email_data['student_email'],
-                    email_data.get('student_name', 'Unknown'),
-                    nudge_level
-                )
-            except Exception as e:
-                print(f"DEBUG: Failed to record nudge: {str(e)}", file=sys.stderr, flush=True)
-    
-    print(json.dumps({
-        'success': True,
-        'sent': success_count,
-        'skipped': skipped_count,
-        'total': len(emails_data),
-        'results': results
-    }), flush=True)
+    if daemon:
+        asyncio.run(run(CONFIG.from_email, from_name, creds, concurrency))
+        return
+    
+    if len(sys.argv) < 2 and sys.stdin.isatty():
+        print_json({'type': 'error', 'message': 'No emails data provided'})
+        sys.exit(1)
+    
+    try:
+        emails_data = read_emails_data()
+    except orjson.JSONDecodeError as e:
+        print_json({'type': 'error', 'message': f'Invalid JSON: {str(e)}'})
+        sys.exit(1)
+    
+    if not asyncio.run(run(CONFIG.from_email, from_name, creds, concurrency, emails_data)):
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,19 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# The scripts are run directly rather than installed, so import them from scripts/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'scripts'))
+os.environ.setdefault('DISABLE_DOTENV', '1')
+
+
+@pytest.fixture
+def nudge_file(tmp_path, monkeypatch):
+    """Point nudge history at a temporary file with a cold cache"""
+    import nudge_system
+    path = tmp_path / 'nudge_history.json'
+    monkeypatch.setattr(nudge_system, 'NUDGE_DATA_FILE', path)
+    monkeypatch.setattr(nudge_system, '_CACHE', {'mtime': None, 'data': None})
+    return path
@@ -0,0 +1,233 @@
+from types import SimpleNamespace
+from dataclasses import replace
+
+import pytest
+
+pd = pytest.importorskip('pandas')
+openpyxl = pytest.importorskip('openpyxl')
+pytest.importorskip('langgraph')
+pytest.importorskip('anthropic')
+orjson = pytest.importorskip('orjson')
+
+import langgraph_agent
+
+HEADERS = ['Student  Name', 'Roll Number', ' Email Address ', 'Gender', 'Date  of Birth']
+ROWS = [
+    ['Asha', 101, 'asha@x.com', 'F', '2001-01-01'],
+    ['Ravi', None, '   ', 'M', None],
+    [None, None, None, None, None],
+    ['Meena', 103, 'meena@x.com', None, '2002-02-02'],
+]
+# Institute, program, stream, education, language and nationality columns are absent from the sheet
+ABSENT = ['institute_name', 'enrolled_program', 'stream', 'previous_education', 'primary_language', 'nationality']
+
+
+def read(file_path):
+    return langgraph_agent.read_excel_node({'file_path': file_path})['students']
+
+
+def check_students(students):
+    # The blank row is dropped, but row_index still points at the original row
+    assert [student['row_index'] for student in students] == [0, 1, 3]
+    asha, ravi, meena = students
+
+    assert asha['student_name'] == 'Asha'
+    assert asha['roll_number'] == '101'
+    assert asha['email'] == 'asha@x.com'
+    assert asha['missing_fields'] == ABSENT
+    assert asha['completion'] == 5 * 100 // len(langgraph_agent.MANDATORY_FIELDS)
+
+    # Blank and whitespace-only cells both count as missing
+    assert ravi['roll_number'] is None and ravi['email'] is None
+    assert ravi['missing_fields'] == ['roll_number', 'institute_name', 'enrolled_program', 'stream', 'date_of_birth', 'email', 'previous_education', 'primary_language', 'nationality']
+    assert ravi['completion'] == 2 * 100 // len(langgraph_agent.MANDATORY_FIELDS)
+
+    assert meena['missing_fields'] == ['institute_name', 'enrolled_program', 'stream', 'gender', 'previous_education', 'primary_language', 'nationality']
+
+
+def test_read_excel_node_xlsx(tmp_path, capsys):
+    workbook = openpyxl.Workbook()
+    sheet = workbook.active
+    sheet.append(HEADERS)
+    for row in ROWS:
+        sheet.append(row)
+    path = tmp_path / 'students.xlsx'
+    workbook.save(path)
+
+    check_students(read(str(path)))
+
+
+def test_read_excel_node_xls_goes_through_pandas(tmp_path, monkeypatch, capsys):
+    # A legacy sheet as pandas returns it with dtype=object: blank cells are NaN
+    frame = pd.DataFrame(ROWS, columns=HEADERS, dtype=object).fillna(float('nan'))
+    reads = []
+
+    def read_excel(file_path, **kwargs):
+        reads.append(kwargs)
+        return frame
+
+    monkeypatch.setattr(langgraph_agent.pd, 'read_excel', read_excel)
+
+    check_students(read(str(tmp_path / 'students.xls')))
+    assert reads == [{'dtype': object}]
+
+
+def student(name, email, missing, completion=50):
+    return {'student_name': name, 'email': email, 'missing_fields': missing, 'completion': completion}
+
+
+def message(subject, body_html):
+    text = orjson.dumps({'subject': subject, 'body_html': body_html}).decode()
+    return SimpleNamespace(content=[SimpleNamespace(text=text)], usage=SimpleNamespace(cache_read_input_tokens=0, cache_creation_input_tokens=0))
+
+
+@pytest.fixture
+def claude(monkeypatch):
+    """Stand in for the concurrent Claude calls; queued replies answer each request in order"""
+    requests = []
+    replies = []
+
+    def run_all(worker, items):
+        requests.extend(items)
+        return [replies.pop(0) for _ in items]
+
+    monkeypatch.setattr(langgraph_agent, '_run_all', run_all)
+    monkeypatch.setattr(langgraph_agent, '_email_cache', {})
+    monkeypatch.setattr(langgraph_agent, 'get_nudge_levels', lambda emails: {email: (1, 0, True) for email in emails})
+    return requests, replies
+
+
+def generate(students):
+    return langgraph_agent.generate_emails_node({'students': students})['generated_emails']
+
+
+def test_one_request_per_email_cache_key(claude, capsys):
+    requests, replies = claude
+    name = langgraph_agent.NAME_PLACEHOLDER
+    replies.extend([message(f'Hi {name}', f'<p>Dear {name}</p>'), message('Stream', '<p>Stream</p>')])
+    students = [
+        student('Asha', 'asha@x.com', ['gender']),
+        student('Ravi', 'ravi@x.com', ['gender'], completion=55),
+        student('Meena', 'meena@x.com', ['stream']),
+    ]
+
+    emails = generate(students)
+
+    # Asha and Ravi share missing fields, nudge level and completion bucket
+    assert len(requests) == 2
+    assert [(email['subject'], email['body_html']) for email in emails] == [
+        ('Hi Asha', '<p>Dear Asha</p>'), ('Hi Ravi', '<p>Dear Ravi</p>'), ('Stream', '<p>Stream</p>'),
+    ]
+
+    # A later run with the same gaps is served from the cache
+    assert generate([student('Kiran', 'kiran@x.com', ['gender'])])[0]['subject'] == 'Hi Kiran'
+    assert len(requests) == 2
+
+
+def test_failed_key_falls_back_for_every_student_and_is_not_cached(claude, capsys):
+    requests, replies = claude
+    replies.append(RuntimeError('overloaded'))
+    students = [student('Asha', 'asha@x.com', ['gender']), student('Ravi', 'ravi@x.com', ['gender'])]
+
+    emails = generate(students)
+
+    assert all('overloaded' in email['analysis']['reasoning'] for email in emails)
+    assert 'Asha' in emails[0]['body_html'] and 'Ravi' in emails[1]['body_html']
+    assert langgraph_agent._email_cache == {}
+
+    # The next run asks Claude again instead of reusing the failure
+    replies.append(message('Hi', '<p>Hi</p>'))
+    assert generate(students[:1])[0]['subject'] == 'Hi'
+    assert len(requests) == 2
+
+
+class FakeBatches:
+    """Message Batches endpoint that ends after a number of polls"""
+
+    def __init__(self, polls=0, entries=(), fail=None):
+        self.polls = polls
+        self.entries = entries
+        self.fail = fail
+        self.cancelled = []
+
+    def batch(self):
+        status = 'ended' if self.polls <= 0 else 'in_progress'
+        counts = SimpleNamespace(succeeded=0, errored=0, canceled=0, expired=0)
+        return SimpleNamespace(id='batch-1', processing_status=status, request_counts=counts)
+
+    def create(self, requests, extra_headers):
+        if self.fail == 'create':
+            raise RuntimeError('create failed')
+        return self.batch()
+
+    def retrieve(self, batch_id):
+        self.polls -= 1
+        return self.batch()
+
+    def results(self, batch_id):
+        for entry in self.entries:
+            if isinstance(entry, Exception):
+                raise entry
+            yield entry
+
+    def cancel(self, batch_id):
+        self.cancelled.append(batch_id)
+
+
+def entry(index, result_type, text=None):
+    return SimpleNamespace(custom_id=f'student-{index}', result=SimpleNamespace(type=result_type, message=text))
+
+
+@pytest.fixture
+def batches(monkeypatch):
+    def install(**kwargs):
+        fake = FakeBatches(**kwargs)
+        client = SimpleNamespace(messages=SimpleNamespace(batches=fake))
+        monkeypatch.setattr(langgraph_agent, 'Anthropic', lambda api_key: client)
+        return fake
+
+    monkeypatch.setattr(langgraph_agent, 'BATCH_POLL_SECONDS', 0)
+    return install
+
+
+def test_run_batch_without_requests_submits_nothing(batches):
+    batches(fail='create')
+
+    assert langgraph_agent._run_batch([]) == []
+
+
+def test_run_batch_maps_results_by_position(batches, capsys):
+    batches(polls=1, entries=[entry(2, 'succeeded', 'third'), entry(0, 'errored')])
+
+    responses = langgraph_agent._run_batch([{}, {}, {}, {}])
+
+    assert str(responses[0]) == 'Batch request errored'
+    assert str(responses[1]) == str(responses[3]) == 'Missing batch result'
+    assert responses[2] == 'third'
+
+
+def test_run_batch_create_failure_fails_every_request(batches):
+    batches(fail='create')
+
+    responses = langgraph_agent._run_batch([{}, {}])
+
+    assert [str(response) for response in responses] == ['create failed', 'create failed']
+
+
+def test_run_batch_keeps_results_read_before_a_failure(batches):
+    batches(entries=[entry(1, 'succeeded', 'second'), ConnectionError('stream dropped')])
+
+    responses = langgraph_agent._run_batch([{}, {}])
+
+    assert isinstance(responses[0], ConnectionError)
+    assert responses[1] == 'second'
+
+
+def test_run_batch_times_out_and_cancels(batches, monkeypatch, capsys):
+    fake = batches(polls=10 ** 6)
+    monkeypatch.setattr(langgraph_agent, 'CONFIG', replace(langgraph_agent.CONFIG, batch_timeout=0.05))
+
+    responses = langgraph_agent._run_batch([{}, {}])
+
+    assert all(isinstance(response, TimeoutError) for response in responses)
+    assert fake.cancelled == ['batch-1']
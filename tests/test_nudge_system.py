@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+orjson = pytest.importorskip('orjson')
+
+import nudge_system
+
+
+def test_record_nudges_round_trips_through_file(nudge_file):
+    nudge_system.record_nudges([('a@x.com', 'Asha', 1), ('b@x.com', 'Ravi', 2)])
+
+    on_disk = orjson.loads(nudge_file.read_bytes())
+    assert on_disk['a@x.com']['nudge_count'] == 1
+    assert on_disk['b@x.com']['student_name'] == 'Ravi'
+    assert nudge_system.load_nudge_history() == on_disk
+
+
+def test_record_nudges_appends_to_existing_history(nudge_file):
+    nudge_system.record_nudges([('a@x.com', 'Asha', 1)])
+    nudge_system.record_nudges([('a@x.com', 'Asha', 2)])
+
+    entry = nudge_system.load_nudge_history()['a@x.com']
+    assert entry['nudge_count'] == 2
+    assert [nudge['level'] for nudge in entry['nudges']] == [1, 2]
+
+
+def test_record_nudges_writes_once_per_batch(nudge_file, monkeypatch):
+    saves = []
+    save = nudge_system.save_nudge_history
+    monkeypatch.setattr(nudge_system, 'save_nudge_history', lambda history: (saves.append(1), save(history)))
+
+    nudge_system.record_nudges([('a@x.com', 'Asha', 1), ('b@x.com', 'Ravi', 1), ('c@x.com', 'Mira', 2)])
+    nudge_system.record_nudges([])
+
+    assert len(saves) == 1
+
+
+def test_load_is_cached_until_file_changes(nudge_file):
+    nudge_system.record_nudges([('a@x.com', 'Asha', 1)])
+    first = nudge_system.load_nudge_history()
+    assert nudge_system.load_nudge_history() is first
+
+    # Another process rewrites the file
+    nudge_file.write_bytes(orjson.dumps({'c@x.com': {'nudge_count': 3}}))
+    stat = nudge_file.stat()
+    os.utime(nudge_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+    assert list(nudge_system.load_nudge_history()) == ['c@x.com']
+
+
+def test_failed_save_leaves_cache_untouched(nudge_file, monkeypatch):
+    nudge_system.record_nudges([('a@x.com', 'Asha', 1)])
+
+    def fail(history):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(nudge_system, 'save_nudge_history', fail)
+    with pytest.raises(OSError):
+        nudge_system.record_nudges([('b@x.com', 'Ravi', 1)])
+
+    assert 'b@x.com' not in nudge_system.load_nudge_history()
+
+
+def test_get_nudge_levels_escalates_after_two_days(nudge_file):
+    nudge_system.record_nudges([('a@x.com', 'Asha', 1)])
+    history = nudge_system.load_nudge_history()
+    history['a@x.com']['last_nudge_date'] = '2000-01-01T00:00:00'
+    nudge_system.save_nudge_history(history)
+
+    levels = nudge_system.get_nudge_levels(['a@x.com', 'new@x.com'])
+    assert levels['a@x.com'][0] == 2 and levels['a@x.com'][2] is True
+    assert levels['new@x.com'] == (1, 0, True)
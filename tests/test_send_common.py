@@ -0,0 +1,175 @@
+import io
+import sys
+import time
+import queue
+import asyncio
+
+import pytest
+
+orjson = pytest.importorskip('orjson')
+
+import nudge_system
+import send_common
+
+
+def email(address, subject='Hi', body='<p>Hi</p>'):
+    return {'student_email': address, 'student_name': 'Student', 'subject': subject, 'body_html': body}
+
+
+def events(capsys):
+    return [orjson.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+@pytest.mark.parametrize('address, valid', [
+    ('a@x.com', True),
+    ('first.last@dept.example.ac.in', True),
+    ('a@x.com\n', False),
+    ('a b@x.com', False),
+    ('a@x', False),
+    ('@x.com', False),
+    ('a@@x.com', False),
+])
+def test_is_valid_email(address, valid):
+    assert send_common.is_valid_email(address) is valid
+
+
+def test_token_bucket_allows_burst_then_paces():
+    async def acquire_all():
+        bucket = send_common.TokenBucket(rate=50, burst=2)
+        start = time.monotonic()
+        for _ in range(2):
+            await bucket.acquire()
+        burst_done = time.monotonic() - start
+        for _ in range(2):
+            await bucket.acquire()
+        return burst_done, time.monotonic() - start
+
+    burst_done, total = asyncio.run(acquire_all())
+    assert burst_done < 0.01
+    # Two more tokens at 50/s take about 40ms
+    assert total >= 0.035
+
+
+async def succeed_all(emails_data, on_result):
+    for index, email_data in enumerate(emails_data):
+        on_result(index, {'status': 'success', 'email': email_data['student_email']})
+
+
+def test_run_batch_streams_results_then_summary(capsys, nudge_file):
+    assert asyncio.run(send_common.run_batch(succeed_all, {'id': 'b1', 'emails': [email('a@x.com'), email('b@x.com')]}))
+
+    out = events(capsys)
+    assert [event['type'] for event in out] == ['start', 'result', 'result', 'summary']
+    assert all(event['batch'] == 'b1' for event in out)
+    assert out[-1]['data'] == {'success': True, 'sent': 2, 'skipped': 0, 'total': 2}
+    assert set(nudge_system.load_nudge_history()) == {'a@x.com', 'b@x.com'}
+
+
+def test_run_batch_records_partial_results_on_failure(capsys, nudge_file):
+    async def fail_midway(emails_data, on_result):
+        on_result(0, {'status': 'success', 'email': emails_data[0]['student_email']})
+        raise KeyError('subject')
+
+    assert not asyncio.run(send_common.run_batch(fail_midway, {'id': 'b1', 'emails': [email('a@x.com'), email('b@x.com')]}))
+
+    out = events(capsys)
+    assert [event['type'] for event in out] == ['start', 'result', 'error']
+    assert out[-1] == {'type': 'error', 'message': "Missing field 'subject'", 'batch': 'b1'}
+    # The email that did go out is not nudged again next run
+    assert set(nudge_system.load_nudge_history()) == {'a@x.com'}
+
+
+def test_run_batch_records_partial_results_when_cancelled(capsys, nudge_file):
+    async def hang_after_first(emails_data, on_result):
+        on_result(0, {'status': 'success', 'email': emails_data[0]['student_email']})
+        await asyncio.sleep(60)
+
+    async def cancel_midway():
+        task = asyncio.create_task(send_common.run_batch(hang_after_first, {'id': 'b1', 'emails': [email('a@x.com'), email('b@x.com')]}))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_midway())
+
+    out = events(capsys)
+    assert [event['type'] for event in out] == ['start', 'result', 'cancelled']
+    assert out[-1]['data'] == {'sent': 1, 'skipped': 0, 'total': 2}
+    assert set(nudge_system.load_nudge_history()) == {'a@x.com'}
+
+
+def test_serve_frames_each_batch_and_survives_bad_lines(capsys, nudge_file, monkeypatch):
+    lines = [
+        orjson.dumps({'id': 'ok', 'emails': [email('a@x.com')]}).decode(),
+        '5',
+        orjson.dumps({'id': 'not-a-list', 'emails': 5}).decode(),
+        orjson.dumps({'id': 'not-objects', 'emails': [7]}).decode(),
+        'not json',
+        '',
+        orjson.dumps([email('b@x.com')]).decode(),
+    ]
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('\n'.join(lines) + '\n'))
+
+    asyncio.run(send_common.serve(succeed_all))
+
+    out = events(capsys)
+    assert [(event['type'], event.get('batch')) for event in out] == [
+        ('start', 'ok'), ('result', 'ok'), ('summary', 'ok'),
+        ('start', None), ('error', None),
+        ('start', 'not-a-list'), ('error', 'not-a-list'),
+        ('start', 'not-objects'), ('error', 'not-objects'),
+        ('error', None),
+        ('start', None), ('result', None), ('summary', None),
+    ]
+    assert out[9]['message'].startswith('Invalid JSON')
+
+
+class FeedStdin:
+    """stdin whose lines arrive while the daemon is running"""
+
+    def __init__(self):
+        self.lines = queue.Queue()
+
+    def feed(self, payload):
+        self.lines.put(orjson.dumps(payload).decode() + '\n')
+
+    def close(self):
+        self.lines.put('')
+
+    def readline(self):
+        return self.lines.get()
+
+
+def test_serve_cancel_line_stops_running_batch_and_drops_queued_one(capsys, nudge_file, monkeypatch):
+    stdin = FeedStdin()
+    monkeypatch.setattr(sys, 'stdin', stdin)
+    started = []
+
+    async def hang_after_first(emails_data, on_result):
+        started.append(1)
+        on_result(0, {'status': 'success', 'email': emails_data[0]['student_email']})
+        await asyncio.sleep(60)
+
+    async def drive():
+        daemon = asyncio.create_task(send_common.serve(hang_after_first))
+        stdin.feed({'id': 'slow', 'emails': [email('a@x.com'), email('b@x.com')]})
+        stdin.feed({'id': 'queued', 'emails': [email('c@x.com')]})
+        while not started:
+            await asyncio.sleep(0.01)
+        stdin.feed({'cancel': 'queued'})
+        stdin.feed({'cancel': 'slow'})
+        stdin.close()
+        await asyncio.wait_for(daemon, 5)
+
+    asyncio.run(drive())
+
+    out = events(capsys)
+    assert [(event['type'], event['batch']) for event in out] == [
+        ('start', 'slow'), ('result', 'slow'), ('cancelled', 'queued'), ('cancelled', 'slow'),
+    ]
+    assert out[2]['data'] == {'sent': 0, 'skipped': 0, 'total': 1}
+    assert out[3]['data'] == {'sent': 1, 'skipped': 0, 'total': 2}
+    # The dropped batch never started, and the stopped one kept its nudge
+    assert len(started) == 1
+    assert set(nudge_system.load_nudge_history()) == {'a@x.com'}
@@ -0,0 +1,258 @@
+import socket
+import asyncio
+
+import pytest
+
+aiosmtplib = pytest.importorskip('aiosmtplib')
+controller_module = pytest.importorskip('aiosmtpd.controller')
+
+import send_emails
+
+CREDS = send_emails.SmtpCreds('sender@gmail.com', 'app-password', 'IIIT Dharwad')
+
+
+class RecordingHandler:
+    """Accept mail like Gmail would, refusing listed recipients with queued replies"""
+
+    def __init__(self):
+        self.messages = []
+        self.refusals = {}
+        self.mail_replies = []
+
+    async def handle_MAIL(self, server, session, envelope, address, mail_options):
+        reply = self.mail_replies.pop(0) if self.mail_replies else None
+        if reply:
+            return reply
+        envelope.mail_from = address
+        envelope.mail_options.extend(mail_options)
+        return '250 OK'
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        replies = self.refusals.get(address)
+        if replies:
+            return replies.pop(0)
+        envelope.rcpt_tos.append(address)
+        return '250 OK'
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append((list(envelope.rcpt_tos), envelope.content))
+        return '250 Message accepted for delivery'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def smtpd(monkeypatch):
+    """Local SMTP server standing in for smtp.gmail.com"""
+    handler = RecordingHandler()
+    controller = controller_module.Controller(handler, hostname='127.0.0.1', port=free_port())
+    controller.start()
+
+    async def open_local(port, creds):
+        server = aiosmtplib.SMTP(hostname='127.0.0.1', port=controller.port, timeout=5)
+        await server.connect()
+        return server
+
+    monkeypatch.setattr(send_emails, '_open_smtp', open_local)
+    monkeypatch.setattr(send_emails, 'RETRY_BASE_SECONDS', 0.01)
+    yield handler
+    controller.stop()
+
+
+def email(address, subject='Complete your profile', body='<p>Hi</p>'):
+    return {'student_email': address, 'student_name': 'Student', 'subject': subject, 'body_html': body}
+
+
+def test_shared_message_is_built_without_recipient_headers():
+    message = send_emails.build_message('Complete your profile', '<p>Hi</p>', CREDS)
+
+    assert b'From: IIIT Dharwad <sender@gmail.com>' in message
+    assert b'\nTo:' not in message and b'Message-ID' not in message
+
+
+def test_each_envelope_gets_its_own_to_and_message_id(smtpd):
+    asyncio.run(send_emails.send_all([email('a@x.com'), email('b@x.com', body='<p>Other</p>')], CREDS))
+
+    contents = sorted(content for _, content in smtpd.messages)
+    assert [content.count(b'Message-ID:') for content in contents] == [1, 1]
+    assert b'To: a@x.com' in contents[0] and b'To: b@x.com' in contents[1]
+
+
+def test_header_injection_is_rejected(smtpd):
+    async def send():
+        connection = await send_emails.SmtpConnection(CREDS).connect()
+        try:
+            message = send_emails.build_message('Hi', '<p>Hi</p>', CREDS)
+            return await send_emails.send_email(connection, ['a@x.com\r\nBcc: evil@x.com'], message, CREDS)
+        finally:
+            await connection.close()
+
+    results = asyncio.run(send())
+
+    assert results[0]['status'] == 'error'
+    assert results[0]['error'].startswith('Invalid header')
+    assert smtpd.messages == []
+
+
+def test_send_all_skips_missing_and_malformed_addresses(smtpd):
+    emails_data = [email('a@x.com'), email(None), email('None'), email('  '), email('not-an-address'), email('b@x.com\n')]
+
+    results = asyncio.run(send_emails.send_all(emails_data, CREDS))
+
+    assert [result['status'] for result in results] == ['success', 'skipped', 'skipped', 'skipped', 'skipped', 'skipped']
+    assert results[1]['error'] == 'Student has no email address'
+    assert results[4]['error'] == results[5]['error'] == 'Invalid email address'
+    assert [recipients for recipients, _ in smtpd.messages] == [['a@x.com']]
+
+
+def test_send_all_groups_shared_messages_into_envelopes(smtpd, monkeypatch):
+    monkeypatch.setattr(send_emails, 'MAX_RECIPIENTS_PER_MESSAGE', 2)
+    emails_data = [email('a@x.com'), email('b@x.com'), email('c@x.com'), email('d@x.com', body='<p>Other</p>')]
+
+    results = asyncio.run(send_emails.send_all(emails_data, CREDS))
+
+    assert all(result['status'] == 'success' for result in results)
+    assert sorted(sorted(recipients) for recipients, _ in smtpd.messages) == [['a@x.com', 'b@x.com'], ['c@x.com'], ['d@x.com']]
+    shared = next(content for recipients, content in smtpd.messages if len(recipients) == 2)
+    # Recipients of a shared envelope don't see each other
+    assert b'To: undisclosed-recipients:;' in shared
+    assert b'b@x.com' not in shared
+
+
+def test_transient_refusal_in_shared_envelope_is_retried(smtpd):
+    smtpd.refusals['a@x.com'] = ['451 4.3.0 Try again later']
+    smtpd.refusals['b@x.com'] = ['550 5.1.1 No such user']
+
+    results = asyncio.run(send_emails.send_all([email('a@x.com'), email('b@x.com'), email('c@x.com')], CREDS))
+
+    assert [result['status'] for result in results] == ['success', 'error', 'success']
+    assert results[1]['error'] == 'SMTP error: 550 5.1.1 No such user'
+    assert [sorted(recipients) for recipients, _ in smtpd.messages] == [['c@x.com'], ['a@x.com']]
+
+
+def test_persistent_transient_refusal_gives_up(smtpd):
+    smtpd.refusals['a@x.com'] = ['450 4.2.1 Mailbox busy'] * send_emails.MAX_SEND_ATTEMPTS
+
+    results = asyncio.run(send_emails.send_all([email('a@x.com')], CREDS))
+
+    assert results[0] == {'status': 'error', 'email': 'a@x.com', 'error': 'SMTP error: 450 4.2.1 Mailbox busy'}
+    assert smtpd.messages == []
+
+
+def test_failed_retry_round_keeps_earlier_deliveries(smtpd):
+    smtpd.refusals['a@x.com'] = ['451 4.3.0 Try again later']
+    # The retry for a@ fails outright after b@ was already delivered
+    smtpd.mail_replies = [None, '552 5.3.4 Message size exceeds limit']
+
+    results = asyncio.run(send_emails.send_all([email('a@x.com'), email('b@x.com')], CREDS))
+
+    assert [recipients for recipients, _ in smtpd.messages] == [['b@x.com']]
+    assert results[0] == {'status': 'error', 'email': 'a@x.com', 'error': 'SMTP error: 552 5.3.4 Message size exceeds limit'}
+    assert results[1]['status'] == 'success'
+
+
+def test_repeated_address_in_group_is_sent_once(smtpd):
+    smtpd.refusals['a@x.com'] = ['451 4.3.0 Try again later']
+
+    results = asyncio.run(send_emails.send_all([email('a@x.com'), email('a@x.com'), email('b@x.com')], CREDS))
+
+    assert [result['status'] for result in results] == ['success', 'success', 'success']
+    assert [recipients for recipients, _ in smtpd.messages] == [['b@x.com'], ['a@x.com']]
+
+
+def test_connection_rotates_by_recipient_count(smtpd, monkeypatch):
+    monkeypatch.setattr(send_emails, 'MAX_MESSAGES_PER_CONNECTION', 3)
+    opened = []
+    open_local = send_emails._open_smtp
+
+    async def counting_open(port, creds):
+        opened.append(port)
+        return await open_local(port, creds)
+
+    monkeypatch.setattr(send_emails, '_open_smtp', counting_open)
+
+    async def send():
+        connection = await send_emails.SmtpConnection(CREDS).connect()
+        try:
+            for recipients in (['a@x.com', 'b@x.com'], ['c@x.com'], ['d@x.com']):
+                await connection.sendmail(CREDS.user, recipients, b'Subject: hi\n\nhi')
+        finally:
+            await connection.close()
+
+    asyncio.run(send())
+
+    # Three recipients fill the first session, so the fourth goes over a fresh one
+    assert len(opened) == 2
+
+
+def test_each_recipient_takes_a_send_token(smtpd, monkeypatch):
+    tokens = []
+
+    class CountingBucket:
+        async def acquire(self):
+            tokens.append(1)
+
+    monkeypatch.setattr(send_emails, '_BUCKET', CountingBucket())
+
+    asyncio.run(send_emails.send_all([email('a@x.com'), email('b@x.com'), email('c@x.com')], CREDS))
+
+    assert len(smtpd.messages) == 1
+    assert len(tokens) == 3
+
+
+def test_send_all_reports_results_as_envelopes_finish(smtpd):
+    reported = []
+
+    asyncio.run(send_emails.send_all([email('a@x.com'), email(None)], CREDS, on_result=lambda index, result: reported.append(index)))
+
+    assert sorted(reported) == [0, 1]
+
+
+@pytest.mark.parametrize('error, code', [
+    (aiosmtplib.SMTPResponseException(451, 'busy'), 451),
+    (aiosmtplib.SMTPRecipientsRefused([aiosmtplib.SMTPRecipientRefused(450, 'busy', 'a@x.com')]), 450),
+    (aiosmtplib.SMTPRecipientsRefused([]), None),
+    (aiosmtplib.SMTPServerDisconnected('gone'), None),
+])
+def test_smtp_error_code(error, code):
+    assert send_emails._smtp_error_code(error) == code
+
+
+def test_with_retry_retries_transient_codes_only(monkeypatch):
+    monkeypatch.setattr(send_emails, 'RETRY_BASE_SECONDS', 0.01)
+    replies = [aiosmtplib.SMTPResponseException(421, 'closing'), aiosmtplib.SMTPResponseException(451, 'later'), 'sent']
+
+    async def flaky():
+        reply = replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    assert asyncio.run(send_emails._with_retry(flaky)) == 'sent'
+
+    calls = []
+
+    async def rejected():
+        calls.append(1)
+        raise aiosmtplib.SMTPResponseException(550, 'no such user')
+
+    with pytest.raises(aiosmtplib.SMTPResponseException):
+        asyncio.run(send_emails._with_retry(rejected))
+    assert len(calls) == 1
+
+
+def test_with_retry_gives_up_after_max_attempts(monkeypatch):
+    monkeypatch.setattr(send_emails, 'RETRY_BASE_SECONDS', 0.01)
+    calls = []
+
+    async def busy():
+        calls.append(1)
+        raise aiosmtplib.SMTPResponseException(421, 'busy')
+
+    with pytest.raises(aiosmtplib.SMTPResponseException):
+        asyncio.run(send_emails._with_retry(busy))
+    assert len(calls) == send_emails.MAX_SEND_ATTEMPTS
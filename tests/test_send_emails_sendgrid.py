@@ -0,0 +1,117 @@
+import json
+import asyncio
+from dataclasses import replace
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+
+httpx = pytest.importorskip('httpx')
+pytest.importorskip('aiosmtplib')
+
+import send_emails_sendgrid
+
+
+def email(address, subject='Complete your profile', body='<p>Hi</p>'):
+    return {'student_email': address, 'student_name': 'Student', 'subject': subject, 'body_html': body}
+
+
+@pytest.fixture
+def sendgrid(monkeypatch):
+    """Route SendGrid calls to a mock that replies with queued status codes (202 once the queue is empty)"""
+    calls = []
+    replies = []
+
+    def handle(request):
+        calls.append(json.loads(request.content))
+        status, headers = replies.pop(0) if replies else (202, {})
+        return httpx.Response(status, headers=headers)
+
+    monkeypatch.setattr(send_emails_sendgrid, 'CONFIG', replace(send_emails_sendgrid.CONFIG, sendgrid_api_key='test-key'))
+    monkeypatch.setattr(send_emails_sendgrid, '_HTTP', httpx.AsyncClient(transport=httpx.MockTransport(handle)))
+    monkeypatch.setattr(send_emails_sendgrid, 'RETRY_BASE_SECONDS', 0.01)
+    return calls, replies
+
+
+def send(emails_data):
+    return asyncio.run(send_emails_sendgrid.send_all(emails_data, 'noreply@x.com', 'IIIT Dharwad', concurrency=5))
+
+
+def test_shared_body_goes_out_as_one_request(sendgrid):
+    calls, _ = sendgrid
+
+    results = send([email('a@x.com', subject='A'), email('b@x.com', subject='B'), email('c@x.com', body='<p>Other</p>')])
+
+    assert all(result['status'] == 'success' for result in results)
+    assert len(calls) == 2
+    shared = next(call for call in calls if len(call['personalizations']) == 2)
+    assert shared['personalizations'] == [
+        {'to': [{'email': 'a@x.com'}], 'subject': 'A'},
+        {'to': [{'email': 'b@x.com'}], 'subject': 'B'},
+    ]
+
+
+def test_large_groups_are_split_at_the_personalization_limit(sendgrid, monkeypatch):
+    calls, _ = sendgrid
+    monkeypatch.setattr(send_emails_sendgrid, 'MAX_PERSONALIZATIONS', 2)
+
+    send([email(f'{name}@x.com') for name in 'abcde'])
+
+    assert sorted(len(call['personalizations']) for call in calls) == [1, 2, 2]
+
+
+def test_missing_and_malformed_addresses_are_skipped(sendgrid):
+    calls, _ = sendgrid
+
+    results = send([email(None), email('bad'), email('a@x.com')])
+
+    assert [result['status'] for result in results] == ['skipped', 'skipped', 'success']
+    assert [personalization['to'][0]['email'] for personalization in calls[0]['personalizations']] == ['a@x.com']
+
+
+def test_throttled_request_is_retried(sendgrid):
+    calls, replies = sendgrid
+    replies.extend([(429, {'Retry-After': '0'}), (503, {})])
+
+    results = send([email('a@x.com')])
+
+    assert results[0]['status'] == 'success'
+    assert len(calls) == 3
+
+
+def test_client_error_is_not_retried(sendgrid):
+    calls, replies = sendgrid
+    replies.append((400, {}))
+
+    results = send([email('a@x.com')])
+
+    assert results[0] == {'status': 'error', 'email': 'a@x.com', 'error': 'SendGrid error: 400'}
+    assert len(calls) == 1
+
+
+def test_missing_api_key_fails_without_sending(sendgrid, monkeypatch):
+    calls, _ = sendgrid
+    monkeypatch.setattr(send_emails_sendgrid, 'CONFIG', replace(send_emails_sendgrid.CONFIG, sendgrid_api_key=None))
+
+    results = send([email('a@x.com')])
+
+    assert results[0]['error'] == 'SENDGRID_API_KEY not configured'
+    assert calls == []
+
+
+def test_retry_after_seconds():
+    assert send_emails_sendgrid._retry_after(httpx.Response(429, headers={'Retry-After': '7'})) == 7.0
+    assert send_emails_sendgrid._retry_after(httpx.Response(429, headers={'Retry-After': '-3'})) == 0.0
+
+
+def test_retry_after_http_date():
+    when = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+
+    delay = send_emails_sendgrid._retry_after(httpx.Response(503, headers={'Retry-After': when}))
+
+    assert 25 <= delay <= 30
+
+
+@pytest.mark.parametrize('headers', [{}, {'Retry-After': 'soon'}])
+def test_retry_after_missing_or_invalid(headers):
+    assert send_emails_sendgrid._retry_after(httpx.Response(429, headers=headers)) is None